@@ -27,7 +27,7 @@ def make_application(ini_file):
     db_plugin = database.make_plugin(plugin_config("database"))
     salons_plugin = salons.make_plugin(db_plugin)
 
-    github.make_plugin(http_plugin, slack_plugin, salons_plugin, db_plugin)
+    github.make_plugin(plugin_config("github"), http_plugin, slack_plugin, salons_plugin, db_plugin)
     deploy.make_plugin(plugin_config("deploy"), http_plugin, slack_plugin, salons_plugin)
     httpchat.make_plugin(http_plugin, slack_plugin)
 
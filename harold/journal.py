@@ -0,0 +1,182 @@
+"""An append-only journal of webhook deliveries.
+
+Each record is a line of JSON metadata (arrival time, headers and body
+length) followed by the raw body. Records are buffered in memory and written
+out periodically as a single gzip member followed by one fsync, so that a
+burst of deliveries costs one disk sync rather than one each. Concatenated
+gzip members are themselves a valid gzip file, and a crash can lose at most
+the member being written.
+
+"""
+
+import collections
+import datetime
+import gzip
+import json
+import os
+import time
+import zlib
+
+from twisted.internet import reactor, task
+from twisted.internet.defer import inlineCallbacks, succeed
+from twisted.internet.threads import deferToThread
+
+from harold import metrics
+
+
+# how often buffered records are written out and synced to disk
+FLUSH_INTERVAL = 1.0
+
+# gzip framing for zlib.compressobj
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+_JournalRecord = collections.namedtuple("JournalRecord", "received headers body")
+
+
+class JournalRecord(_JournalRecord):
+    def header(self, name, default=None):
+        name = name.lower()
+        for key, value in self.headers.iteritems():
+            if key.lower() == name:
+                return value
+        return default
+
+
+def _encode_record(received, headers, body):
+    metadata = json.dumps({
+        "received": received,
+        "headers": headers,
+        "length": len(body),
+    })
+    return "".join((metadata, "\n", body, "\n"))
+
+
+class JournalWriter(object):
+    def __init__(self, directory, max_file_size):
+        self.directory = directory
+        self.max_file_size = max_file_size
+
+        self._buffer = []
+        self._flushing = None
+        self._file = None
+        self._file_size = 0
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        metrics.register_gauge("journal.buffered", lambda: len(self._buffer))
+
+        self._flusher = task.LoopingCall(self.flush)
+        self._flusher.start(FLUSH_INTERVAL, now=False)
+        reactor.addSystemEventTrigger("before", "shutdown", self.close)
+
+    def append(self, headers, body, received=None):
+        received = received or time.time()
+        self._buffer.append(_encode_record(received, headers, body))
+
+    def flush(self):
+        # only one batch is ever in flight. anything arriving in the meantime
+        # will be picked up by the next flush.
+        if self._flushing:
+            return self._flushing
+
+        if not self._buffer:
+            return succeed(None)
+
+        batch, self._buffer = self._buffer, []
+        self._flushing = deferToThread(self._write_batch, batch)
+        self._flushing.addCallback(self._record_batch, len(batch))
+        self._flushing.addErrback(self._log_failure)
+        self._flushing.addBoth(self._on_flushed)
+        return self._flushing
+
+    def _on_flushed(self, result):
+        self._flushing = None
+        return result
+
+    def _record_batch(self, elapsed, count):
+        # metrics aren't thread safe, so the writer thread leaves this to us
+        metrics.increment("journal.records", count)
+        metrics.record_timing("journal.commit", elapsed)
+
+    def _log_failure(self, failure):
+        metrics.increment("journal.errors")
+        print("Failed to write webhook journal: %s" % failure.getErrorMessage())
+
+    @inlineCallbacks
+    def close(self):
+        if self._flusher.running:
+            self._flusher.stop()
+
+        # records can arrive while a batch is being written, so keep going
+        # until there's nothing left rather than just waiting on that batch
+        while self._flushing or self._buffer:
+            yield self.flush()
+
+        yield deferToThread(self._close_file)
+
+    # everything below runs in a thread, one batch at a time
+    def _write_batch(self, batch):
+        start = time.time()
+
+        compressor = zlib.compressobj(6, zlib.DEFLATED, _GZIP_WBITS)
+        data = compressor.compress("".join(batch)) + compressor.flush()
+
+        if self._file and self._file_size + len(data) > self.max_file_size:
+            self._close_file()
+
+        if not self._file:
+            self._open_file()
+
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file_size += len(data)
+
+        return time.time() - start
+
+    def _open_file(self):
+        filename = "webhooks-%s.journal.gz" % (
+            datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S.%f"))
+        self._file = open(os.path.join(self.directory, filename), "ab")
+        self._file_size = 0
+
+    def _close_file(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+def _journal_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for filename in sorted(os.listdir(path)):
+                if filename.endswith(".journal.gz"):
+                    yield os.path.join(path, filename)
+        else:
+            yield path
+
+
+def read_journal(paths):
+    """Yield JournalRecords from journal files or directories of them.
+
+    A truncated final member (e.g. from a crash mid-write) ends that file.
+
+    """
+    for path in _journal_files(paths):
+        with gzip.open(path, "rb") as f:
+            while True:
+                try:
+                    line = f.readline()
+                    if not line:
+                        break
+                    metadata = json.loads(line)
+                    body = f.read(metadata["length"])
+                    f.read(1)
+                except (IOError, EOFError, ValueError, zlib.error):
+                    print("Journal %s ends with a truncated record." % path)
+                    break
+
+                yield JournalRecord(
+                    metadata["received"], metadata["headers"], body)
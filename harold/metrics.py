@@ -0,0 +1,71 @@
+import collections
+import contextlib
+import time
+
+
+# process-wide instrumentation. plugins record into these and the http plugin
+# serves a snapshot of everything at /harold/metrics.
+_counters = collections.Counter()
+_gauges = {}
+_timers = {}
+
+
+class _Timer(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.,
+            "max": self.max,
+        }
+
+
+def increment(name, delta=1):
+    _counters[name] += delta
+
+
+def register_gauge(name, fn):
+    "Register a callable that will be asked for the gauge's current value."
+    _gauges[name] = fn
+
+
+def record_timing(name, seconds):
+    try:
+        timer = _timers[name]
+    except KeyError:
+        timer = _timers[name] = _Timer()
+    timer.record(seconds)
+
+
+@contextlib.contextmanager
+def timed(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        record_timing(name, time.time() - start)
+
+
+def snapshot():
+    gauges = {}
+    for name, fn in _gauges.iteritems():
+        try:
+            gauges[name] = fn()
+        except Exception as exc:
+            gauges[name] = "error: %s" % exc
+
+    return {
+        "counters": dict(_counters),
+        "gauges": gauges,
+        "timers": {name: t.to_dict() for name, t in _timers.iteritems()},
+    }
@@ -0,0 +1,154 @@
+"""Versioned schema for the database harold and salon share.
+
+Both apply these on startup. The version is kept in SQLite's user_version
+so an existing database with no version is treated as brand new, which is
+safe because the first migration only creates what's missing.
+
+Migrations are only ever appended. Once one has shipped, changes go in a
+new one.
+
+"""
+
+MIGRATIONS = [
+    # 1: the tables as harold and salon have always used them
+    [
+        "CREATE TABLE IF NOT EXISTS salons ("
+        " name VARCHAR NOT NULL,"
+        " conch_emoji VARCHAR NOT NULL,"
+        " deploy_hours_start VARCHAR,"
+        " deploy_hours_end VARCHAR,"
+        " tz VARCHAR,"
+        " allow_deploys BOOLEAN,"
+        " after_hours_message VARCHAR,"
+        " PRIMARY KEY (name))",
+
+        "CREATE TABLE IF NOT EXISTS repositories ("
+        " name VARCHAR NOT NULL,"
+        " salon VARCHAR NOT NULL,"
+        " format VARCHAR,"
+        " bundled_format VARCHAR,"
+        " branches VARCHAR,"
+        " PRIMARY KEY (name),"
+        " FOREIGN KEY(salon) REFERENCES salons (name))",
+
+        "CREATE TABLE IF NOT EXISTS users ("
+        " irc_nick VARCHAR NOT NULL,"
+        " github_username VARCHAR NOT NULL,"
+        " PRIMARY KEY (irc_nick))",
+
+        "CREATE TABLE IF NOT EXISTS emails ("
+        " email_address VARCHAR NOT NULL,"
+        " opted_into_nags BOOLEAN,"
+        " PRIMARY KEY (email_address))",
+
+        "CREATE TABLE IF NOT EXISTS github_pull_requests ("
+        " repository VARCHAR NOT NULL,"
+        " id INTEGER NOT NULL,"
+        " created DATETIME NOT NULL,"
+        " author VARCHAR NOT NULL,"
+        " state VARCHAR NOT NULL,"
+        " title VARCHAR,"
+        " url VARCHAR,"
+        " PRIMARY KEY (repository, id))",
+
+        "CREATE TABLE IF NOT EXISTS github_review_states ("
+        " repository VARCHAR NOT NULL,"
+        " pull_request_id INTEGER NOT NULL,"
+        " user VARCHAR NOT NULL,"
+        " timestamp DATETIME NOT NULL,"
+        " state VARCHAR NOT NULL,"
+        " PRIMARY KEY (repository, pull_request_id, user),"
+        " FOREIGN KEY(repository, pull_request_id)"
+        "  REFERENCES github_pull_requests (repository, id))",
+
+        "CREATE TABLE IF NOT EXISTS github_deliveries ("
+        " id VARCHAR NOT NULL,"
+        " received DATETIME NOT NULL,"
+        " PRIMARY KEY (id))",
+
+        "CREATE TABLE IF NOT EXISTS events ("
+        " id INTEGER NOT NULL,"
+        " actor VARCHAR NOT NULL,"
+        " event VARCHAR NOT NULL,"
+        " timestamp DATETIME NOT NULL,"
+        " repository VARCHAR NOT NULL,"
+        " pull_request_id INTEGER NOT NULL,"
+        " info JSON NOT NULL,"
+        " PRIMARY KEY (id))",
+    ],
+
+    # 2: indexes for the queries run on every webhook, command and page view
+    [
+        # case-insensitive lookups by name
+        "CREATE INDEX IF NOT EXISTS ix_salons_lower_name"
+        " ON salons (lower(name))",
+        "CREATE INDEX IF NOT EXISTS ix_repositories_lower_name"
+        " ON repositories (lower(name))",
+
+        # salon's open pull requests: all, by author, and by repository
+        "CREATE INDEX IF NOT EXISTS ix_github_pull_requests_state"
+        " ON github_pull_requests (state, created)",
+        "CREATE INDEX IF NOT EXISTS ix_github_pull_requests_author"
+        " ON github_pull_requests (state, lower(author), created)",
+        "CREATE INDEX IF NOT EXISTS ix_github_pull_requests_repository"
+        " ON github_pull_requests (state, lower(repository), created)",
+
+        # salon's review queue for a user
+        "CREATE INDEX IF NOT EXISTS ix_github_review_states_user"
+        " ON github_review_states (lower(user), timestamp)",
+        # a pull request's reviewers, answered from the index alone
+        "CREATE INDEX IF NOT EXISTS ix_github_review_states_pull_request"
+        " ON github_review_states (repository, pull_request_id, state, user)",
+
+        # the event log and metrics scan by time, optionally for some users
+        "CREATE INDEX IF NOT EXISTS ix_events_timestamp"
+        " ON events (timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_events_actor"
+        " ON events (actor, timestamp)",
+
+        # delivery ids are pruned and loaded by age at startup
+        "CREATE INDEX IF NOT EXISTS ix_github_deliveries_received"
+        " ON github_deliveries (received)",
+    ],
+]
+
+
+def get_version(connection):
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+
+def upgrade(connection):
+    """Apply any migrations the database doesn't have yet.
+
+    The connection must be a sqlite3 connection. Everything is done in one
+    transaction that takes the write lock up front, so if harold and salon
+    start at the same time, one waits for the other and then finds nothing
+    left to do.
+
+    Returns the list of versions that were applied.
+
+    """
+    isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    try:
+        cursor = connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            version = get_version(connection)
+            applied = []
+            for number, statements in enumerate(MIGRATIONS, start=1):
+                if number <= version:
+                    continue
+                for statement in statements:
+                    cursor.execute(statement)
+                applied.append(number)
+
+            if applied:
+                cursor.execute("PRAGMA user_version = %d" % applied[-1])
+            cursor.execute("COMMIT")
+        except:
+            cursor.execute("ROLLBACK")
+            raise
+        return applied
+    finally:
+        connection.isolation_level = isolation_level
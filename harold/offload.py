@@ -0,0 +1,139 @@
+"""Run CPU-heavy functions in a pool of worker processes.
+
+Everything in harold otherwise happens on the reactor thread, so decoding a
+multi-megabyte payload there stalls chat keepalives and every other request
+until it's done. Functions run through the pool must be defined at module
+level and take and return picklable values.
+
+"""
+
+import multiprocessing
+import signal
+import time
+import traceback
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, fail
+from twisted.python.failure import Failure
+
+from harold import metrics
+
+
+class OffloadError(Exception):
+    pass
+
+
+class OffloadTimeoutError(OffloadError):
+    pass
+
+
+def _init_worker():
+    # leave interrupts to the parent, which will shut us down. the pool is
+    # forked from a running reactor, so undo twisted's SIGTERM handler too or
+    # terminating the pool would wait forever on workers that won't exit.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def _call(fn, args):
+    # runs in a worker. exceptions are flattened to text because they aren't
+    # necessarily picklable.
+    start = time.time()
+    try:
+        result = fn(*args)
+    except Exception:
+        return False, traceback.format_exc(), time.time() - start
+    return True, result, time.time() - start
+
+
+class ProcessPool(object):
+    def __init__(self, processes, timeout=60):
+        self.processes = processes
+        self.timeout = timeout
+        self._pool = None
+        # Deferred -> (fn, args, submitted at) for every job not yet answered
+        self._pending = {}
+
+        metrics.register_gauge("offload.pending", lambda: len(self._pending))
+        reactor.addSystemEventTrigger("before", "shutdown", self.close)
+
+    def _start_pool(self):
+        self._pool = multiprocessing.Pool(
+            self.processes, initializer=_init_worker)
+
+    def run(self, fn, *args):
+        """Call fn(*args) in a worker process.
+
+        Returns a Deferred that fires with the result or fails with an
+        OffloadError describing the worker's exception. If no result arrives
+        within the pool's timeout, e.g. because the worker was killed, it
+        fails with OffloadTimeoutError and the pool is restarted.
+
+        """
+        if self._pool is None:
+            # started on first use so that the workers are forked from the
+            # process that'll actually be running, i.e. after daemonizing.
+            self._start_pool()
+
+        d = Deferred(lambda d: self._pending.pop(d, None))
+        metrics.increment("offload.jobs")
+
+        try:
+            self._submit(d, fn, args)
+        except Exception:
+            return fail()
+        self._pending[d] = (fn, args, time.time())
+
+        d.addTimeout(self.timeout, reactor, onTimeoutCancel=self._on_timeout)
+        return d
+
+    def _submit(self, d, fn, args):
+        def on_result(result):
+            # called on the pool's result handling thread
+            reactor.callFromThread(self._on_result, d, result)
+
+        self._pool.apply_async(_call, (fn, args), callback=on_result)
+
+    def _on_result(self, d, result):
+        job = self._pending.pop(d, None)
+        if job is None:
+            return
+        start = job[2]
+
+        succeeded, value, elapsed = result
+        metrics.record_timing("offload.execute", elapsed)
+        metrics.record_timing("offload.round_trip", time.time() - start)
+
+        if succeeded:
+            d.callback(value)
+        else:
+            metrics.increment("offload.errors")
+            d.errback(OffloadError(value))
+
+    def _on_timeout(self, result, timeout):
+        metrics.increment("offload.timeouts")
+        self._restart()
+        return Failure(OffloadTimeoutError(
+            "no result from worker after %g seconds" % timeout))
+
+    def _restart(self):
+        # the pool never hears back about a job whose worker died, and a
+        # wedged worker never comes back at all. start over with fresh
+        # workers and give them whatever the old ones were still holding.
+        print("Restarting offload pool")
+        if self._pool is not None:
+            self._pool.terminate()
+        self._start_pool()
+        metrics.increment("offload.restarts")
+
+        for d, (fn, args, start) in self._pending.items():
+            self._submit(d, fn, args)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+        pending, self._pending = self._pending, {}
+        for d in pending:
+            d.errback(OffloadError("process pool shut down"))
@@ -1,6 +1,17 @@
+import Queue
+import datetime
+import sqlite3
+import threading
+import time
+
 from baseplate import config
 from sqlalchemy.engine import url
 from twisted.enterprise.adbapi import ConnectionPool
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.python.failure import Failure
+
+from harold import metrics, migrations
 
 
 class DatabasePlugin(ConnectionPool):
@@ -12,8 +23,222 @@ class DatabasePlugin(ConnectionPool):
         ConnectionPool.__init__(self, self.module.__name__, **kwargs)
 
 
+class _WriteJob(object):
+    __slots__ = ("deferred", "fn", "args", "kwargs", "queued")
+
+    def __init__(self, fn, args, kwargs):
+        self.deferred = Deferred()
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.queued = time.time()
+
+
+class SQLiteDatabasePlugin(object):
+    """The same interface as DatabasePlugin, tuned for SQLite under load.
+
+    With several pool threads writing at once, SQLite can only let one of
+    them have the database lock and the rest fail with "database is locked".
+    Instead, every write (runOperation and runInteraction) goes through a
+    single writer thread, which commits whatever has queued up behind the
+    current write along with it. Each write gets its own savepoint so one
+    failing doesn't take the others in its batch down with it.
+
+    Reads (runQuery) are served from a separate pool. The database is put in
+    WAL mode so that they, and the salon web app, don't block or get blocked
+    by the writer.
+
+    """
+
+    module = sqlite3
+
+    def __init__(self, path, busy_timeout=5., read_pool_size=3,
+                 max_write_batch=100):
+        self._path = path
+        self._busy_timeout = busy_timeout
+        self._max_write_batch = max_write_batch
+        self._queue = Queue.Queue()
+        self._stopped = None
+
+        self._readers = ConnectionPool(
+            "sqlite3", path,
+            check_same_thread=False,
+            cp_min=1,
+            cp_max=read_pool_size,
+            cp_openfun=self._configure_reader,
+        )
+
+        self._writer = threading.Thread(
+            target=self._write_loop, name="sqlite-writer")
+        self._writer.daemon = True
+        self._writer.start()
+
+        metrics.register_gauge("db.write.queue", self._queue.qsize)
+        reactor.addSystemEventTrigger("before", "shutdown", self.close)
+
+    def _configure(self, connection):
+        connection.execute(
+            "PRAGMA busy_timeout = %d" % int(self._busy_timeout * 1000))
+
+    def _configure_reader(self, connection):
+        self._configure(connection)
+        connection.execute("PRAGMA query_only = ON")
+
+    def runQuery(self, *args, **kwargs):
+        start = time.time()
+        d = self._readers.runQuery(*args, **kwargs)
+
+        def record(result):
+            metrics.record_timing("db.read", time.time() - start)
+            return result
+        d.addBoth(record)
+        return d
+
+    def runOperation(self, *args, **kwargs):
+        d = self.runInteraction(self._operation, *args, **kwargs)
+        d.addCallback(lambda result: None)
+        return d
+
+    def _operation(self, cursor, *args, **kwargs):
+        cursor.execute(*args, **kwargs)
+
+    def runInteraction(self, fn, *args, **kwargs):
+        if self._stopped:
+            return fail(RuntimeError("database is shut down"))
+        job = _WriteJob(fn, args, kwargs)
+        self._queue.put(job)
+        return job.deferred
+
+    def close(self):
+        if self._stopped is None:
+            self._stopped = Deferred()
+            self._queue.put(None)
+        if not self._writer.is_alive():
+            return succeed(None)
+        return self._stopped
+
+    # everything below here runs on the writer thread. results and
+    # measurements are handed back to the reactor with callFromThread.
+    def _write_loop(self):
+        # transactions are managed by hand, not by the sqlite3 module
+        connection = sqlite3.connect(self._path, isolation_level=None)
+        self._configure(connection)
+        connection.execute("PRAGMA journal_mode = WAL")
+        # in WAL mode this is still safe against corruption, it only risks
+        # losing the last commits on power loss, and saves an fsync a batch.
+        connection.execute("PRAGMA synchronous = NORMAL")
+
+        stopping = False
+        while not stopping:
+            job = self._queue.get()
+            if job is None:
+                break
+
+            batch = [job]
+            while len(batch) < self._max_write_batch:
+                try:
+                    job = self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if job is None:
+                    stopping = True
+                    break
+                batch.append(job)
+
+            self._run_batch(connection, batch)
+
+        connection.close()
+        reactor.callFromThread(self._stopped.callback, None)
+
+    def _run_batch(self, connection, batch):
+        cursor = connection.cursor()
+        start = time.time()
+        try:
+            # take the write lock up front so that waiting on it is clearly
+            # separated from actually doing the work.
+            cursor.execute("BEGIN IMMEDIATE")
+        except Exception:
+            failure = Failure()
+            reactor.callFromThread(
+                self._finish_batch, batch, [(False, failure)] * len(batch),
+                start, None, time.time())
+            return
+        locked = time.time()
+
+        try:
+            results = []
+            for job in batch:
+                cursor.execute("SAVEPOINT job")
+                try:
+                    result = job.fn(cursor, *job.args, **job.kwargs)
+                except Exception:
+                    results.append((False, Failure()))
+                    cursor.execute("ROLLBACK TO job")
+                else:
+                    results.append((True, result))
+                cursor.execute("RELEASE job")
+
+            cursor.execute("COMMIT")
+        except Exception:
+            failure = Failure()
+            try:
+                cursor.execute("ROLLBACK")
+            except Exception:
+                pass
+            results = [(False, failure)] * len(batch)
+
+        reactor.callFromThread(
+            self._finish_batch, batch, results, start, locked, time.time())
+
+    def _finish_batch(self, batch, results, start, locked, finished):
+        metrics.increment("db.write.batches")
+        metrics.increment("db.write.jobs", len(batch))
+        if locked is not None:
+            metrics.record_timing("db.write.lock_wait", locked - start)
+            metrics.record_timing("db.write.batch", finished - locked)
+
+        for job, (succeeded, result) in zip(batch, results):
+            metrics.record_timing("db.write.queue_wait", start - job.queued)
+            if succeeded:
+                job.deferred.callback(result)
+            else:
+                metrics.increment("db.write.errors")
+                job.deferred.errback(result)
+
+
 def make_plugin(app_config):
     db_config = config.parse_config(app_config, {
         "connection_string": url.make_url,
+        "sqlite_single_writer": config.Optional(config.Boolean, default=False),
+        "busy_timeout": config.Optional(
+            config.Timespan, default=datetime.timedelta(seconds=5)),
+        "read_pool_size": config.Optional(config.Integer, default=3),
+        "max_write_batch": config.Optional(config.Integer, default=100),
     })
+
+    connection_string = db_config.connection_string
+    is_sqlite = connection_string.get_backend_name() == "sqlite"
+
+    if is_sqlite:
+        # done before anything else can touch the database
+        connection = sqlite3.connect(
+            connection_string.database, timeout=db_config.busy_timeout.total_seconds())
+        try:
+            applied = migrations.upgrade(connection)
+        finally:
+            connection.close()
+        if applied:
+            print("Applied database migrations: %s" % ", ".join(map(str, applied)))
+
+    if db_config.sqlite_single_writer:
+        if not is_sqlite:
+            raise ValueError("sqlite_single_writer only works with sqlite")
+
+        return SQLiteDatabasePlugin(
+            connection_string.database,
+            busy_timeout=db_config.busy_timeout.total_seconds(),
+            read_pool_size=db_config.read_pool_size,
+            max_write_batch=db_config.max_write_batch,
+        )
+
     return DatabasePlugin(db_config)
@@ -15,6 +15,7 @@ from twisted.web import resource, server
 from twisted.internet import reactor, task
 from twisted.internet.defer import inlineCallbacks, returnValue
 
+from harold import metrics
 from harold.plugins.http import ProtectedResource
 from harold.plugins.salons import WouldOrphanRepositoriesError
 from harold.utils import (
@@ -40,6 +41,13 @@ CONCH_TTL = 60*55
 # how long in seconds they have to respond before we actually expire it
 CONCH_GRACE = 60*5
 
+# topic changes are written once the topic has stopped changing for this many
+# seconds, so a burst of changes becomes a single write of the final topic
+TOPIC_QUIET_PERIOD = 2
+
+# but a topic that keeps changing is still written at least this often
+TOPIC_MAX_DELAY = 10
+
 
 class DeployHoldType(Enum):
     code_freeze = 'Code Freeze'
@@ -248,12 +256,7 @@ class Salon(object):
         self.db = db
         self.name = config.name
         self.channel = config.channel
-        self.allow_deploys = config.allow_deploys
-        self.conch_emoji = config.conch_emoji.encode("utf-8")
-        self.deploy_hours_start = config.deploy_hours_start
-        self.deploy_hours_end = config.deploy_hours_end
-        self.after_hours_message = config.after_hours_message
-        self.tz = config.tz
+        self.apply_config(config)
         self.deploys = {}
         self.current_hold = None
         self.current_hold_type = None
@@ -261,8 +264,19 @@ class Salon(object):
         self.current_conch = ""
         self.queue = []
         self.current_topic = self._make_topic()
+        self.pending_topic = None
+        self.pending_topic_since = None
+        self.topic_timer = None
         self.conch_lease = None
 
+    def apply_config(self, config):
+        self.allow_deploys = config.allow_deploys
+        self.conch_emoji = config.conch_emoji.encode("utf-8")
+        self.deploy_hours_start = config.deploy_hours_start
+        self.deploy_hours_end = config.deploy_hours_end
+        self.after_hours_message = config.after_hours_message
+        self.tz = config.tz
+
     def _make_topic(self):
         deploy_count = len(self.deploys)
 
@@ -301,9 +315,54 @@ class Salon(object):
             return
 
         new_topic = self._make_topic()
-        if force or new_topic != self.current_topic:
-            irc.set_topic(self.channel, new_topic)
-            self.current_topic = new_topic
+
+        if force:
+            self._cancel_pending_topic()
+            self._write_topic(irc, new_topic)
+            return
+
+        if new_topic == self.pending_topic:
+            return
+
+        if self.pending_topic is not None:
+            # superseded before it was ever written
+            metrics.increment("deploy.topic.suppressed")
+
+        if new_topic == self.current_topic:
+            self._cancel_pending_topic()
+            return
+
+        now = time.time()
+        if self.pending_topic is None:
+            self.pending_topic_since = now
+        self.pending_topic = new_topic
+
+        delay = min(TOPIC_QUIET_PERIOD,
+                    self.pending_topic_since + TOPIC_MAX_DELAY - now)
+        if self.topic_timer and self.topic_timer.active():
+            self.topic_timer.reset(max(delay, 0))
+        else:
+            self.topic_timer = reactor.callLater(
+                max(delay, 0), self._flush_topic, irc)
+
+    def _cancel_pending_topic(self):
+        if self.topic_timer and self.topic_timer.active():
+            self.topic_timer.cancel()
+        self.topic_timer = None
+        self.pending_topic = None
+        self.pending_topic_since = None
+
+    def _flush_topic(self, irc):
+        topic = self.pending_topic
+        self.topic_timer = None
+        self.pending_topic = None
+        self.pending_topic_since = None
+        self._write_topic(irc, topic)
+
+    def _write_topic(self, irc, topic):
+        metrics.increment("deploy.topic.writes")
+        irc.set_topic(self.channel, topic)
+        self.current_topic = topic
 
     def update_conch(self, irc):
         if self.queue:
@@ -316,14 +375,14 @@ class Salon(object):
                     after_hours_message = " -- " + self.after_hours_message
 
                 if self.current_hold is not None:
-                    irc.send_message(self.channel, "@%s: you have the %s (but deploys are on hold%s)" % (new_conch, self.conch_emoji, after_hours_message))
+                    irc.send_message(self.channel, "@%s: you have the %s (but deploys are on hold%s)" % (new_conch, self.conch_emoji, after_hours_message), priority="high")
                 elif not is_work_hours:
-                    irc.send_message(self.channel, "@%s: you have the %s (but it's after hours%s)" % (new_conch, self.conch_emoji, after_hours_message))
+                    irc.send_message(self.channel, "@%s: you have the %s (but it's after hours%s)" % (new_conch, self.conch_emoji, after_hours_message), priority="high")
                 else:
-                    irc.send_message(self.channel, "@%s: you have the %s" % (new_conch, self.conch_emoji))
+                    irc.send_message(self.channel, "@%s: you have the %s" % (new_conch, self.conch_emoji), priority="high")
 
                 if len(self.queue) > 1:
-                    irc.send_message(self.channel, "@%s: you're up next. please get ready!" % self.queue[1])
+                    irc.send_message(self.channel, "@%s: you're up next. please get ready!" % self.queue[1], priority="high")
 
                 self.reset_conch_lease(irc, new_conch)
         else:
@@ -344,16 +403,16 @@ class Salon(object):
     def warn_conch_lease_expiration(self, irc):
         if self.current_conch:
             if self.deploys:
-                irc.send_message(self.channel, "automatically extending your time with the %s since a deploy is ongoing" % (self.conch_emoji,))
+                irc.send_message(self.channel, "automatically extending your time with the %s since a deploy is ongoing" % (self.conch_emoji,), priority="high")
                 self.conch_lease = reactor.callLater(CONCH_GRACE, self.warn_conch_lease_expiration, irc)
                 return
 
-            irc.send_message(self.channel, "@%s: your time with the %s expires in 5 minutes. if you still need it, say `harold acquire`" % (self.current_conch, self.conch_emoji))
+            irc.send_message(self.channel, "@%s: your time with the %s expires in 5 minutes. if you still need it, say `harold acquire`" % (self.current_conch, self.conch_emoji), priority="high")
             self.conch_lease = reactor.callLater(CONCH_GRACE, self.expire_conch, irc)
 
     def expire_conch(self, irc):
         if self.current_conch:
-            irc.send_message(self.channel, "@%s: your time with the %s has reached an end" % (self.current_conch, self.conch_emoji))
+            irc.send_message(self.channel, "@%s: your time with the %s has reached an end" % (self.current_conch, self.conch_emoji), priority="high")
             self.queue.remove(self.current_conch)
             self.conch_lease = None
 
@@ -460,22 +519,62 @@ class Salon(object):
 
 
 class SalonManager(object):
+    """The salons, loaded from the database once and then kept in memory.
+
+    Changes made through harold are applied to both. Anything changed
+    directly in the database is only picked up by reload().
+
+    """
+
     def __init__(self, salon_config_db):
         self.salon_config_db = salon_config_db
         self.salons = {}
+        self._loaded = False
+        self._loading = None
 
         looper = task.LoopingCall(self._write_status)
         looper.start(10)
 
+    def reload(self):
+        "Bring the salons in line with the database."
+        d = self._loading
+        if d is None:
+            d = self._loading = self._load()
+            d.addBoth(self._on_loaded)
+        return d
+
+    def _on_loaded(self, result):
+        self._loading = None
+        return result
+
     @inlineCallbacks
-    def all(self):
+    def _load(self):
         salon_configs = yield self.salon_config_db.get_salons()
+
+        seen = set()
         for salon_config in salon_configs:
-            if "#" + salon_config.name not in self.salons:
-                self.salons["#" + salon_config.name] = Salon(
+            channel = "#" + salon_config.name
+            seen.add(channel)
+
+            salon = self.salons.get(channel)
+            if salon:
+                salon.apply_config(salon_config)
+            else:
+                self.salons[channel] = Salon(
                     self.salon_config_db,
                     salon_config,
                 )
+
+        for channel in set(self.salons) - seen:
+            self.salons.pop(channel)._cancel_pending_topic()
+
+        self._loaded = True
+        metrics.increment("deploy.salons.reload")
+
+    @inlineCallbacks
+    def all(self):
+        if not self._loaded:
+            yield self.reload()
         returnValue(self.salons.values())
 
     @inlineCallbacks
@@ -514,7 +613,7 @@ class SalonManager(object):
     @inlineCallbacks
     def destroy(self, channel_name):
         yield self.salon_config_db.delete_salon(channel_name.lstrip("#"))
-        del self.salons[channel_name]
+        self.salons.pop(channel_name)._cancel_pending_topic()
 
     def _write_status(self):
         try:
@@ -723,6 +822,12 @@ class DeployMonitor(object):
                 irc.send_message(channel, "%s is not managed in any salon" % (repo_name,))
 
             returnValue(None)
+        elif subcommand == "reload":
+            # for picking up changes made directly in the database, like
+            # branch filters
+            self.salons.salon_config_db.invalidate_repositories()
+            irc.send_message(channel, "Reloading repository settings.")
+            returnValue(None)
 
         salon = yield self.salons.by_channel(channel)
         if not salon:
@@ -964,6 +1069,13 @@ class DeployMonitor(object):
         for salon in salons:
             salon.update_topic(irc, force=True)
 
+    @inlineCallbacks
+    def reload(self, irc, sender, channel):
+        "Pick up changes made directly to salons and repositories in the DB."
+        self.salons.salon_config_db.invalidate_repositories()
+        yield self.salons.reload()
+        irc.send_message(channel, "Reloaded %d salons." % len(self.salons.salons))
+
     @inlineCallbacks
     def onPushBegan(self, salon_name, id, who, args, log_path, count):
         salon = yield self.salons.by_name(salon_name)
@@ -987,7 +1099,8 @@ class DeployMonitor(object):
 
         self.irc.bot.send_message(salon.channel,
                                   '@%s started deploy "%s" '
-                                  "with args %s" % (who, id, args))
+                                  "with args %s" % (who, id, args),
+                                  priority="high")
 
     @inlineCallbacks
     def onPushProgress(self, salon_name, id, host, index):
@@ -1035,7 +1148,8 @@ class DeployMonitor(object):
         self.irc.bot.send_message(
             salon.channel,
             """deploy "%s" by @%s is complete. """
-            "Took %s." % (id, who, pretty_and_accurate_time_span(duration))
+            "Took %s." % (id, who, pretty_and_accurate_time_span(duration)),
+            priority="high",
         )
         salon.update_topic(self.irc.bot)
 
@@ -1045,7 +1159,8 @@ class DeployMonitor(object):
                 "Deploy `%s` in %s encountered errors on the "
                     "following hosts: %s. See %s for more information." % (
                         id, salon.channel, ", ".join(sorted(failed_hosts)),
-                        deploy.log_path)
+                        deploy.log_path),
+                priority="high",
             )
 
     @inlineCallbacks
@@ -1062,7 +1177,8 @@ class DeployMonitor(object):
         self.irc.bot.send_message(salon.channel,
                                   ("""deploy "%s" by @%s encountered """
                                    "an error: %s") %
-                                  (id, deploy.who, error))
+                                  (id, deploy.who, error),
+                                  priority="high")
 
     @inlineCallbacks
     def onPushAborted(self, salon_name, id, reason):
@@ -1077,7 +1193,8 @@ class DeployMonitor(object):
 
         self.irc.bot.send_message(salon.channel,
                                   """deploy "%s" by @%s aborted (%s)""" %
-                                  (id, who, reason))
+                                  (id, who, reason),
+                                  priority="high")
         salon.update_topic(self.irc.bot)
 
     @inlineCallbacks
@@ -1102,7 +1219,7 @@ class DeployMonitor(object):
 
         for salon in salons:
             irc.send_message(salon.channel, ":siren: ANNOUNCEMENT FROM @%s: %s" % (
-                sender, message))
+                sender, message), priority="high")
 
 
 def make_plugin(app_config, http, irc, salons):
@@ -1151,6 +1268,7 @@ def make_plugin(app_config, http, irc, salons):
     irc.register_command(monitor.kick)
     irc.register_command(monitor.refresh)
     irc.register_command(monitor.refresh_all)
+    irc.register_command(monitor.reload)
     irc.register_command(monitor.forget)
     irc.register_command(monitor.announce)
     irc.register_command(monitor.set_deploy_hours)
@@ -2,9 +2,24 @@ import collections
 import datetime
 import json
 import re
-
-from twisted.internet.defer import inlineCallbacks, returnValue
-
+import time
+import traceback
+import urlparse
+
+from baseplate import config
+from twisted.internet import reactor, task
+from twisted.internet.defer import (
+    Deferred,
+    DeferredSemaphore,
+    inlineCallbacks,
+    maybeDeferred,
+    returnValue,
+)
+from twisted.python.failure import Failure
+
+from harold import metrics
+from harold.journal import JournalWriter
+from harold.offload import ProcessPool
 from harold.plugins.http import ProtectedResource
 from harold.utils import dehilight
 
@@ -22,13 +37,106 @@ _MENTION_RE = re.compile(r"@([A-Za-z0-9][A-Za-z0-9-]*)")
 def _extract_reviewers(body):
     if not body:
         return []
+    return Salon.scan_text(body).reviewers
+
+
+def _compile_token_scanner(tokens):
+    """Compile a regex finding any of the given emoji tokens in one pass.
+
+    Tokens shaped like :name: don't consume their closing colon so that
+    neighbours sharing it (e.g. ":fish:running:") are both found. The
+    returned regex's matches are keys of the returned dict, whose values are
+    the tokens they came from.
+
+    """
+    keys = {}
+    for token in tokens:
+        if token.startswith(":") and token.endswith(":"):
+            keys[token[:-1]] = token
+        else:
+            keys[token] = token
+
+    # longest first so that e.g. ":running_man:" wins over any shorter prefix.
+    # every alternative starts with a literal so the regex engine can skip
+    # ahead to candidate characters rather than trying every position.
+    alternation = u"|".join(
+        re.escape(key) + (u"(?=:)" if keys[key] != key else u"")
+        for key in sorted(keys, key=len, reverse=True))
+    return re.compile(alternation), keys
+
+
+# the characters unicode.splitlines() considers line boundaries
+_LINE_BREAKS_RE = re.compile(u"[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]")
+def _line_bounds(text, position):
+    start = text.rfind(u"\n", 0, position) + 1
+    for match in _LINE_BREAKS_RE.finditer(text, start, position):
+        start = match.end()
+    match = _LINE_BREAKS_RE.search(text, position)
+    end = match.start() if match else len(text)
+    return start, end
+
+
+EmojiScan = collections.namedtuple("EmojiScan", "emoji reviewers")
+
+
+def _get_payload(request):
+    """Return the JSON document from a webhook delivery.
+
+    GitHub can be configured to send either a form-encoded body with the JSON
+    in a "payload" field or the JSON as the body itself.
+
+    """
+    content_type = request.requestHeaders.getRawHeaders("Content-Type", [""])[0]
+    if content_type.startswith("application/json"):
+        request.content.seek(0)
+        return request.content.read()
+    return request.args["payload"][0]
+
 
-    body = Salon.rewrite_emoji(body)
-    reviewers = set()
-    for line in body.splitlines():
-        if ":eyeglasses:" in line:
-            reviewers.update(_MENTION_RE.findall(line))
-    return reviewers
+def payload_from_body(content_type, body):
+    "Like _get_payload but for a raw body, e.g. one read from the journal."
+    if content_type.startswith("application/json"):
+        return body
+    return urlparse.parse_qs(body)["payload"][0]
+
+
+# per-file change lists in push payloads. nothing here reads them and they're
+# most of what makes a big push big.
+_UNUSED_COMMIT_FIELDS = ("added", "removed", "modified")
+
+
+def decode_payload(event, payload):
+    """Parse a webhook's JSON, dropping parts no dispatcher looks at.
+
+    This is the expensive part of handling large deliveries and so it's what
+    gets sent to the offload pool when that's configured.
+
+    """
+    parsed = json.loads(payload)
+    if event == "push":
+        commits = list(parsed.get("commits") or [])
+        if parsed.get("head_commit"):
+            commits.append(parsed["head_commit"])
+        for commit in commits:
+            for field in _UNUSED_COMMIT_FIELDS:
+                commit.pop(field, None)
+    return parsed
+
+
+def _get_pull_request_key(event, parsed):
+    "Return (repository, pull request number) for events about a PR."
+    try:
+        if event == "pull_request":
+            number = parsed["number"]
+        elif event == "issue_comment":
+            number = parsed["issue"]["number"]
+        elif event == "pull_request_review":
+            number = parsed["pull_request"]["number"]
+        else:
+            return None
+        return parsed["repository"]["full_name"].lower(), int(number)
+    except (KeyError, TypeError, ValueError):
+        return None
 
 
 def _get_commit_author(commit):
@@ -45,8 +153,11 @@ class PushDispatcher(object):
     @inlineCallbacks
     def _dispatch_commit(self, sender_username, repository, branch, commit):
         short_url = commit['url']
-        sender = yield self.salons.get_nick_for_user(sender_username)
-        author = yield self.salons.get_nick_for_user(_get_commit_author(commit))
+        author_username = _get_commit_author(commit)
+        nicks = yield self.salons.get_nicks_for_users(
+            [sender_username, author_username])
+        sender = nicks[sender_username]
+        author = nicks[author_username]
 
         if sender == author:
             format = "%(sender)s pushed %(commit_id)s (%(url)s) to %(repository)s/%(branch)s: %(summary)s"
@@ -62,16 +173,18 @@ class PushDispatcher(object):
             'url': short_url,
             'author': author,
             'summary': commit['message'].splitlines()[0]
-        })
+        }, priority="low")
 
     @inlineCallbacks
     def _dispatch_bundle(self, sender_username, info, repository, branch, commits):
-        sender = yield self.salons.get_nick_for_user(sender_username)
+        author_usernames = [_get_commit_author(commit) for commit in commits]
+        nicks = yield self.salons.get_nicks_for_users(
+            [sender_username] + author_usernames)
+        sender = nicks[sender_username]
 
         authors = collections.Counter()
-        for commit in commits:
-            nick = yield self.salons.get_nick_for_user(_get_commit_author(commit))
-            authors[nick] += 1
+        for author_username in author_usernames:
+            authors[nicks[author_username]] += 1
 
         before = info['before']
         after = info['after']
@@ -92,7 +205,7 @@ class PushDispatcher(object):
             'commit_count': len(commits),
             'commit_range': commit_range,
             'url': short_url,
-        })
+        }, priority="low")
 
     @inlineCallbacks
     def _get_repository(self, parsed):
@@ -126,66 +239,44 @@ class PushDispatcher(object):
                 self._dispatch_bundle(sender, parsed, repository, branch, commits)
 
 
+# how many pull requests' stored rows we remember to skip redundant upserts
+_PULL_REQUEST_CACHE_SIZE = 5000
+
+
 class SalonDatabase(object):
     def __init__(self, database):
         self.database = database
 
-    @inlineCallbacks
-    def _insert(self, table, data, replace_on_conflict=False):
-        if not self.database:
-            return
+        # what we last wrote to github_pull_requests, by (repository, id)
+        self._pull_request_rows = collections.OrderedDict()
 
+    @staticmethod
+    def _make_insert_query(table, data, on_conflict=None):
         # this isn't as bad as it looks. just the table/column names are
         # done with string concatenation; those should be coming from
         # hard-coded strings in the source and therefore safe. actual data
         # is parameterized.
-        query = (
+        return (
             "INSERT %(conflict)s INTO %(table)s (%(columns)s) "
             "VALUES (%(placeholders)s);" % {
-                "conflict": "OR REPLACE" if replace_on_conflict else "",
+                "conflict": "OR " + on_conflict if on_conflict else "",
                 "table": table,
                 "columns": ", ".join(data.iterkeys()),
                 "placeholders": ", ".join(":" + x for x in data.iterkeys()),
             }
         )
-        yield self.database.runOperation(query, data)
-
-    def _upsert(self, table, data):
-        return self._insert(table, data, replace_on_conflict=True)
 
     @inlineCallbacks
-    def _delete(self, table, data):
+    def _insert(self, table, data, replace_on_conflict=False):
         if not self.database:
             return
 
-        # this isn't as bad as it looks. just the table/column names are
-        # done with string concatenation; those should be coming from
-        # hard-coded strings in the source and therefore safe. actual data
-        # is parameterized.
-        query = (
-            "DELETE FROM %(table)s WHERE %(conditions)s" % {
-                "table": table,
-                "conditions": " AND ".join("{0} = :{0}".format(column_name)
-                                           for column_name in data.iterkeys()),
-            }
-        )
+        query = self._make_insert_query(
+            table, data, "REPLACE" if replace_on_conflict else None)
         yield self.database.runOperation(query, data)
 
-    @inlineCallbacks
-    def _is_author(self, repo, pr_id, username):
-        if not self.database:
-            return
-
-        rows = yield self.database.runQuery(
-            "SELECT COUNT(*) FROM github_pull_requests WHERE "
-            "repository = :repository AND id = :id AND author = :username",
-            {
-                "repository": repo,
-                "id": pr_id,
-                "username": username,
-            }
-        )
-        returnValue(bool(rows[0][0]))
+    def _upsert(self, table, data):
+        return self._insert(table, data, replace_on_conflict=True)
 
     @inlineCallbacks
     def process_pullrequest(self, sender, pull_request, repository):
@@ -193,7 +284,7 @@ class SalonDatabase(object):
         id = int(pull_request["number"])
 
         timestamp = _parse_timestamp(pull_request["created_at"])
-        yield self._upsert("github_pull_requests", {
+        row = {
             "repository": repo,
             "id": id,
             "created": timestamp,
@@ -201,20 +292,131 @@ class SalonDatabase(object):
             "state": pull_request["state"],
             "title": pull_request["title"],
             "url": pull_request["html_url"],
-        })
+        }
 
-    @inlineCallbacks
-    def update_review_state(self, repo, pr_id, body, timestamp, user, emoji):
-        is_author = yield self._is_author(repo, pr_id, user)
+        # most pull request events (synchronize, labeled, etc.) don't change
+        # anything we store so there's no point in writing the row again.
+        key = (repo, id)
+        digest = (timestamp, row["author"], row["state"], row["title"], row["url"])
+        if self._pull_request_rows.pop(key, None) == digest:
+            self._pull_request_rows[key] = digest
+            metrics.increment("github.pull_requests.writes_skipped")
+            return
+
+        yield self._upsert("github_pull_requests", row)
+        metrics.increment("github.pull_requests.writes")
+
+        self._pull_request_rows[key] = digest
+        while len(self._pull_request_rows) > _PULL_REQUEST_CACHE_SIZE:
+            self._pull_request_rows.popitem(last=False)
+
+    # each review state transition below is done as a single interaction so
+    # that it's one trip to a database thread and atomic. the _txn_* helpers
+    # run inside those interactions, on the database thread.
+    def _txn_is_author(self, transaction, repo, pr_id, username):
+        transaction.execute(
+            "SELECT COUNT(*) FROM github_pull_requests WHERE "
+            "repository = :repository AND id = :id AND author = :username",
+            {
+                "repository": repo,
+                "id": pr_id,
+                "username": username,
+            }
+        )
+        return bool(transaction.fetchone()[0])
+
+    def _txn_get_reviewers(self, transaction, repo, pr_id):
+        transaction.execute(
+            "SELECT user FROM github_review_states WHERE "
+            "repository = :repo AND pull_request_id = :prid AND "
+            "state != 'running' AND "
+            "user != (SELECT author FROM github_pull_requests "
+            "         WHERE repository = :repo AND id = :prid)",
+            {
+                "repo": repo,
+                "prid": pr_id,
+            }
+        )
+        return [reviewer for reviewer, in transaction.fetchall()]
+
+    def _txn_emit_event(self, transaction, actor, event, repository,
+                        pull_request_id, timestamp=None, **kwargs):
+        data = {
+            "actor": actor,
+            "event": event,
+            "timestamp": timestamp or datetime.datetime.utcnow(),
+            "repository": repository,
+            "pull_request_id": pull_request_id,
+            "info": json.dumps(kwargs),
+        }
+        transaction.execute(self._make_insert_query("events", data), data)
+
+    def _txn_add_review_request(self, transaction, sender, repo,
+                                pull_request_id, username, timestamp):
+        params = {
+            "repo": repo,
+            "prid": pull_request_id,
+            "user": username,
+            "timestamp": timestamp,
+        }
+
+        transaction.execute(
+            "SELECT 1 FROM github_review_states WHERE "
+            "repository = :repo AND pull_request_id = :prid AND user = :user",
+            params,
+        )
+        is_new = transaction.fetchone() is None
+
+        if is_new:
+            transaction.execute(
+                "INSERT INTO github_review_states "
+                "(repository, pull_request_id, user, timestamp, state) "
+                "VALUES (:repo, :prid, :user, :timestamp, 'unreviewed');",
+                params,
+            )
+            did_haircut = False
+        else:
+            transaction.execute(
+                "UPDATE github_review_states SET state = 'haircut', timestamp = :timestamp "
+                    "WHERE repository = :repo AND "
+                    "   pull_request_id = :prid AND "
+                    "   user = :user AND "
+                    "   state != 'unreviewed';",
+                params,
+            )
+            did_haircut = transaction.rowcount > 0
+
+        if is_new or did_haircut:
+            self._txn_emit_event(
+                transaction,
+                actor=sender,
+                event="review_requested",
+                repository=repo,
+                pull_request_id=pull_request_id,
+                timestamp=timestamp,
+                targets=[username],
+            )
+
+        return is_new
+
+    def _txn_add_mentions(self, transaction, sender, repo, id, mentions, timestamp):
+        for mention in mentions:
+            self._txn_add_review_request(
+                transaction, sender, repo, id, mention, timestamp)
+
+    def _txn_update_review_state(self, transaction, repo, pr_id, mentions,
+                                 timestamp, user, emoji):
+        is_author = self._txn_is_author(transaction, repo, pr_id, user)
         if is_author:
-            yield self._add_mentions(user, repo, pr_id, body, timestamp)
+            self._txn_add_mentions(
+                transaction, user, repo, pr_id, mentions, timestamp)
 
         state = "unreviewed"
         event_name = None
         if is_author and emoji == ":haircut:":
             state = "haircut"
             event_name = "review_requested"
-            targets = yield self.get_reviewers(repo, pr_id)
+            targets = self._txn_get_reviewers(transaction, repo, pr_id)
             event_info = {"targets": targets}
         elif emoji == ":running:":
             state = "running"
@@ -231,20 +433,21 @@ class SalonDatabase(object):
 
         should_overwrite = (state != "unreviewed")
 
-        try:
-            yield self._insert("github_review_states", {
-                "repository": repo,
-                "pull_request_id": pr_id,
-                "user": user,
-                "timestamp": timestamp,
-                "state": state,
-            }, replace_on_conflict=should_overwrite)
-        except self.database.module.IntegrityError:
-            if should_overwrite:
-                raise
+        data = {
+            "repository": repo,
+            "pull_request_id": pr_id,
+            "user": user,
+            "timestamp": timestamp,
+            "state": state,
+        }
+        query = self._make_insert_query(
+            "github_review_states", data,
+            "REPLACE" if should_overwrite else "IGNORE")
+        transaction.execute(query, data)
 
         if event_name:
-            yield self.emit_event(
+            self._txn_emit_event(
+                transaction,
                 actor=user,
                 event=event_name,
                 repository=repo,
@@ -253,80 +456,67 @@ class SalonDatabase(object):
                 **event_info
             )
 
+    @inlineCallbacks
+    def update_review_state(self, repo, pr_id, mentions, timestamp, user, emoji):
+        if not self.database:
+            return
+
+        yield self.database.runInteraction(
+            self._txn_update_review_state,
+            repo, pr_id, mentions, timestamp, user, emoji)
+
     @inlineCallbacks
     def add_review_request(self, sender, repo, pull_request_id, username, timestamp):
-        try:
-            yield self._insert("github_review_states", {
-                "repository": repo,
-                "pull_request_id": pull_request_id,
-                "user": username,
-                "timestamp": timestamp,
-                "state": "unreviewed",
-            })
-            is_new = True
-            did_haircut = False
-        except self.database.module.IntegrityError:
-            def maybe_haircut(transaction):
-                transaction.execute(
-                    "UPDATE github_review_states SET state = 'haircut', timestamp = :timestamp "
-                        "WHERE repository = :repo AND "
-                        "   pull_request_id = :prid AND "
-                        "   user = :user AND "
-                        "   state != 'unreviewed';",
-                    {
-                        "repo": repo,
-                        "prid": pull_request_id,
-                        "user": username,
-                        "timestamp": timestamp,
-                    },
-                )
-                return transaction.rowcount > 0
-            is_new = False
-            did_haircut = yield self.database.runInteraction(maybe_haircut)
+        if not self.database:
+            returnValue(True)
 
-        if is_new or did_haircut:
-            yield self.emit_event(
+        is_new = yield self.database.runInteraction(
+            self._txn_add_review_request,
+            sender, repo, pull_request_id, username, timestamp)
+        returnValue(is_new)
+
+    @inlineCallbacks
+    def remove_review_request(self, sender, repo, pull_request_id, username):
+        if not self.database:
+            return
+
+        def remove(transaction):
+            transaction.execute(
+                "DELETE FROM github_review_states WHERE "
+                "repository = :repo AND pull_request_id = :prid AND user = :user",
+                {
+                    "repo": repo,
+                    "prid": pull_request_id,
+                    "user": username,
+                },
+            )
+            self._txn_emit_event(
+                transaction,
                 actor=sender,
-                event="review_requested",
+                event="review_request_removed",
                 repository=repo,
                 pull_request_id=pull_request_id,
-                timestamp=timestamp,
                 targets=[username],
             )
-
-        returnValue(is_new)
+        yield self.database.runInteraction(remove)
 
     @inlineCallbacks
-    def remove_review_request(self, repo, pull_request_id, username):
-        yield self._delete("github_review_states", {
-            "repository": repo,
-            "pull_request_id": pull_request_id,
-            "user": username,
-        })
+    def _add_mentions(self, sender, repo, id, mentions, timestamp):
+        if not self.database:
+            return
 
-    @inlineCallbacks
-    def _add_mentions(self, sender, repo, id, body, timestamp):
-        for mention in _extract_reviewers(body):
-            yield self.add_review_request(sender, repo, id, mention, timestamp)
+        if mentions:
+            yield self.database.runInteraction(
+                self._txn_add_mentions, sender, repo, id, mentions, timestamp)
 
     @inlineCallbacks
     def get_reviewers(self, repo, pr_id):
         if not self.database:
             returnValue([])
 
-        rows = yield self.database.runQuery(
-            "SELECT user FROM github_review_states WHERE "
-            "repository = :repo AND pull_request_id = :prid AND "
-            "state != 'running' AND "
-            "user != (SELECT author FROM github_pull_requests "
-            "         WHERE repository = :repo AND id = :prid)",
-            {
-                "repo": repo,
-                "prid": pr_id,
-            }
-        )
-
-        returnValue([reviewer for reviewer, in rows])
+        reviewers = yield self.database.runInteraction(
+            self._txn_get_reviewers, repo, pr_id)
+        returnValue(reviewers)
 
     @inlineCallbacks
     def emit_event(self, actor, event, repository, pull_request_id, timestamp=None, **kwargs):
@@ -380,6 +570,23 @@ class Salon(object):
                      "(%(short_url)s) at this time. Please summon a new "
                      "reviewer.",
     }
+    # raw and rewritten emoji are recognized in the same pass
+    _emoji_re, _emoji_tokens = _compile_token_scanner(
+        [pattern for pattern, replacement in emoji_rewrites] +
+        list(messages_by_emoji))
+    _emoji_canonical = dict(emoji_rewrites)
+    # when a line has several emoji, the one that counts is whichever comes
+    # first in the dict's iteration order.
+    _emoji_rank = {emoji: i for i, emoji in enumerate(messages_by_emoji)}
+
+    # pull request actions that do more than update the stored PR
+    pull_request_actions = frozenset((
+        "opened",
+        "reopened",
+        "closed",
+        "review_requested",
+        "review_request_removed",
+    ))
 
     def __init__(self, bot, salons, database):
         self.bot = bot
@@ -389,8 +596,16 @@ class Salon(object):
     @inlineCallbacks
     def dispatch_pullrequest(self, parsed):
         pull_request = parsed["pull_request"]
-        timestamp = _parse_timestamp(pull_request["created_at"])
         repository_name = parsed["repository"]["full_name"]
+
+        if parsed["action"] not in self.pull_request_actions:
+            # nothing to announce or record, just keep the stored PR current
+            metrics.increment("github.pull_requests.lookups_skipped")
+            yield self.database.process_pullrequest(
+                parsed["sender"]["login"], pull_request, repository_name)
+            return
+
+        timestamp = _parse_timestamp(pull_request["created_at"])
         repository = yield self.salons.get_repository(repository_name)
         pull_request_id = parsed["number"]
         sender_username = parsed["sender"]["login"]
@@ -405,11 +620,12 @@ class Salon(object):
                 timestamp=timestamp,
             )
 
+            reviewer_usernames = _extract_reviewers(pull_request["body"])
             yield self.database._add_mentions(
                 sender_username,
                 repository_name,
                 pull_request_id,
-                pull_request["body"],
+                reviewer_usernames,
                 timestamp,
             )
 
@@ -453,18 +669,11 @@ class Salon(object):
         elif parsed["action"] == "review_request_removed":
             username = parsed["requested_reviewer"]["login"]
             yield self.database.remove_review_request(
+                sender=sender_username,
                 repo=repository_name,
                 pull_request_id=pull_request_id,
                 username=username,
             )
-
-            yield self.database.emit_event(
-                actor=sender_username,
-                event="review_request_removed",
-                repository=repository_name,
-                pull_request_id=pull_request_id,
-                targets=[username],
-            )
         elif parsed["action"] == "opened":
             message = ("%(user)s opened pull request #%(id)d (%(short_url)s) "
                        "on %(repo)s: %(title)s")
@@ -478,11 +687,9 @@ class Salon(object):
                     title=pull_request["title"][:72],
                 ))
 
-            reviewer_usernames = _extract_reviewers(pull_request["body"])
-            reviewers = []
-            for reviewer_username in reviewer_usernames:
-                nick = yield self.salons.get_nick_for_user(reviewer_username)
-                reviewers.append(nick)
+            nicks = yield self.salons.get_nicks_for_users(reviewer_usernames)
+            reviewers = [nicks[reviewer_username]
+                         for reviewer_username in reviewer_usernames]
             if repository and reviewers:
                 message = self.messages_by_emoji[":eyeglasses:"]
                 self.bot.send_message(repository.channel, message % {
@@ -518,26 +725,60 @@ class Salon(object):
 
         return text
 
-    def find_emoji(self, text):
-        text = self.rewrite_emoji(text)
+    @classmethod
+    def scan_text(cls, text):
+        """Find the actionable emoji and requested reviewers in a body.
+
+        The emoji is the first one found outside of quoted lines. Reviewers
+        are mentioned on any line with :eyeglasses:, quoted or not. This is
+        equivalent to rewrite_emoji() followed by a line-by-line search, but
+        only lines that actually contain an emoji are ever looked at.
 
-        for line in text.splitlines():
-            if line.startswith(">"):
+        """
+        if not isinstance(text, unicode):
+            text = text.decode("utf8")
+
+        emoji = None
+        emoji_line_end = None
+        reviewers = set()
+        line_end = -1
+        for match in cls._emoji_re.finditer(text):
+            token = cls._emoji_tokens[match.group(0)]
+            found = cls._emoji_canonical.get(token, token)
+
+            if match.start() >= line_end:
+                line_start, line_end = _line_bounds(text, match.start())
+                line = text[line_start:line_end]
+                quoted = line.startswith(">")
+                mentioned = False
+
+            if found == ":eyeglasses:" and not mentioned:
+                reviewers.update(_MENTION_RE.findall(line))
+                mentioned = True
+
+            if quoted or (emoji is not None and emoji_line_end != line_end):
                 continue
-            for emoji, message in self.messages_by_emoji.iteritems():
-                if emoji in line:
-                    return emoji, message
-        return None, None
+            if emoji is None or cls._emoji_rank[found] < cls._emoji_rank[emoji]:
+                emoji = found
+                emoji_line_end = line_end
+        return EmojiScan(emoji, reviewers)
+
+    def find_emoji(self, text):
+        emoji = self.scan_text(text).emoji
+        if not emoji:
+            return None, None
+        return emoji, self.messages_by_emoji[emoji]
 
     @inlineCallbacks
     def dispatch_comment(self, parsed):
         if parsed["action"] != "created":
             return
 
-        body = parsed["comment"]["body"]
-        emoji, message = self.find_emoji(body)
+        scan = self.scan_text(parsed["comment"]["body"])
+        emoji = scan.emoji
         if not emoji:
             return
+        message = self.messages_by_emoji[emoji]
 
         repository_name = parsed["repository"]["full_name"]
         repository = yield self.salons.get_repository(repository_name)
@@ -546,11 +787,15 @@ class Salon(object):
         timestamp = _parse_timestamp(parsed["comment"]["created_at"])
 
         yield self.database.update_review_state(
-            repository_name, pr_id, parsed["comment"]["body"],
+            repository_name, pr_id, scan.reviewers,
             timestamp, parsed["sender"]["login"], emoji)
 
-        owner = yield self.salons.get_nick_for_user(parsed["issue"]["user"]["login"])
-        user = yield self.salons.get_nick_for_user(parsed["sender"]["login"])
+        owner_username = parsed["issue"]["user"]["login"]
+        sender_username = parsed["sender"]["login"]
+        nicks = yield self.salons.get_nicks_for_users(
+            [owner_username, sender_username])
+        owner = nicks[owner_username]
+        user = nicks[sender_username]
         message_info = dict(
             user=dehilight(user),
             owner=owner,
@@ -562,17 +807,16 @@ class Salon(object):
 
         if "%(reviewers)s" in message:
             if emoji == ":eyeglasses:":
-                reviewers = _extract_reviewers(body)
+                reviewers = scan.reviewers
                 if not reviewers:
                     return
             else:
                 reviewers = yield self.database.get_reviewers(repository_name,
                                                               pr_id)
 
-            mapped_reviewers = []
-            for reviewer_username in reviewers:
-                nick = yield self.salons.get_nick_for_user(reviewer_username)
-                mapped_reviewers.append(nick)
+            nicks = yield self.salons.get_nicks_for_users(reviewers)
+            mapped_reviewers = [nicks[reviewer_username]
+                                for reviewer_username in reviewers]
             message_info["reviewers"] = " & ".join(mapped_reviewers or
                                                   ["(no one in particular)"])
 
@@ -601,11 +845,13 @@ class Salon(object):
         message = self.messages_by_emoji[emoji]
 
         yield self.database.update_review_state(
-            repository_name, pr_id, parsed["review"]["body"],
+            repository_name, pr_id, _extract_reviewers(parsed["review"]["body"]),
             timestamp, sender, emoji)
 
-        owner = yield self.salons.get_nick_for_user(parsed["pull_request"]["user"]["login"])
-        user = yield self.salons.get_nick_for_user(parsed["sender"]["login"])
+        owner_username = parsed["pull_request"]["user"]["login"]
+        nicks = yield self.salons.get_nicks_for_users([owner_username, sender])
+        owner = nicks[owner_username]
+        user = nicks[sender]
         message_info = dict(
             user=dehilight(user),
             owner=owner,
@@ -617,10 +863,9 @@ class Salon(object):
 
         if "%(reviewers)s" in message:
             reviewers = yield self.database.get_reviewers(repository_name, pr_id)
-            mapped_reviewers = []
-            for reviewer_username in reviewers:
-                nick = yield self.salons.get_nick_for_user(reviewer_username)
-                mapped_reviewers.append(nick)
+            nicks = yield self.salons.get_nicks_for_users(reviewers)
+            mapped_reviewers = [nicks[reviewer_username]
+                                for reviewer_username in reviewers]
             message_info["reviewers"] = " & ".join(mapped_reviewers or
                                                   ["(no one in particular)"])
 
@@ -628,13 +873,275 @@ class Salon(object):
             self.bot.send_message(repository.channel, message % message_info)
 
 
+class OrderedLanes(object):
+    """Runs work for the same key strictly in order.
+
+    Work for different keys runs in parallel, but only up to `limit` keys at
+    once. This keeps concurrent webhooks for one pull request from
+    interleaving their database round trips.
+
+    """
+
+    def __init__(self, limit):
+        self._lanes = {}
+        self._semaphore = DeferredSemaphore(limit)
+
+        metrics.register_gauge("github.lanes.active", lambda: len(self._lanes))
+        metrics.register_gauge(
+            "github.lanes.waiting", lambda: len(self._semaphore.waiting))
+        metrics.register_gauge("github.lanes.backlog", self._get_backlog)
+
+    def _get_backlog(self):
+        return {"%s#%d" % key: len(lane) for key, lane in self._lanes.iteritems()}
+
+    def run(self, key, fn, *args):
+        d = Deferred()
+        lane = self._lanes.get(key)
+        if lane is not None:
+            lane.append((fn, args, d))
+        else:
+            lane = self._lanes[key] = collections.deque([(fn, args, d)])
+            self._semaphore.run(self._drain, key, lane)
+        return d
+
+    @inlineCallbacks
+    def _drain(self, key, lane):
+        while lane:
+            fn, args, d = lane[0]
+            try:
+                result = yield maybeDeferred(fn, *args)
+            except Exception:
+                lane.popleft()
+                d.errback(Failure())
+            else:
+                lane.popleft()
+                d.callback(result)
+        del self._lanes[key]
+
+
+class WebhookQueueFullError(Exception):
+    pass
+
+
+QueuedDelivery = collections.namedtuple(
+    "QueuedDelivery", "event payload received delivery_id")
+
+
+# placeholder for a delivery whose payload hasn't finished decoding yet
+_DECODING = object()
+
+
+class WebhookQueue(object):
+    """A bounded buffer between accepting webhooks and processing them.
+
+    Deliveries are drained by a fixed number of concurrent workers so that a
+    burst of webhooks doesn't all hit the database and chat at once.
+
+    """
+
+    def __init__(self, dispatchers, size, workers, lanes, offload=None,
+                 offload_threshold=None, deliveries=None):
+        self.dispatchers = dispatchers
+        self.size = size
+        self.workers = workers
+        self.lanes = lanes
+        self.offload = offload
+        self.offload_threshold = offload_threshold
+        self.deliveries = deliveries
+        self._pending = collections.deque()
+        self._decoding = collections.deque()
+        self._active = 0
+        self._wakeup = None
+
+        metrics.register_gauge("github.queue.depth", lambda: len(self._pending))
+        metrics.register_gauge("github.queue.active", lambda: self._active)
+        metrics.register_gauge(
+            "github.queue.decoding", lambda: len(self._decoding))
+
+    def put(self, event, payload, delivery_id=None):
+        if len(self._pending) >= self.size:
+            metrics.increment("github.queue.dropped")
+            raise WebhookQueueFullError
+
+        self._pending.append(
+            QueuedDelivery(event, payload, time.time(), delivery_id))
+        metrics.increment("github.queue.accepted")
+        self._maybe_start_workers()
+
+    def _maybe_start_workers(self):
+        # processing always starts on a later reactor iteration so the
+        # response to the delivery that woke us isn't held up by it.
+        if self._wakeup or not self._pending or self._active >= self.workers:
+            return
+        self._wakeup = reactor.callLater(0, self._start_workers)
+
+    def _start_workers(self):
+        self._wakeup = None
+        while self._pending and self._active < self.workers:
+            delivery = self._pending.popleft()
+            self._active += 1
+            metrics.record_timing(
+                "github.queue.wait", time.time() - delivery.received)
+
+            decoding = [delivery, _DECODING]
+            self._decoding.append(decoding)
+            d = self._decode(delivery)
+            d.addBoth(self._on_decoded, decoding)
+
+    def _decode(self, delivery):
+        if self.offload and len(delivery.payload) >= self.offload_threshold:
+            metrics.increment("github.queue.offloaded")
+            return self.offload.run(decode_payload, delivery.event, delivery.payload)
+        return maybeDeferred(decode_payload, delivery.event, delivery.payload)
+
+    def _on_decoded(self, result, decoding):
+        decoding[1] = result
+
+        # offloaded deliveries can finish decoding out of order. hand them
+        # on strictly in arrival order so that the lanes see each pull
+        # request's events in the order github sent them.
+        while self._decoding and self._decoding[0][1] is not _DECODING:
+            delivery, parsed = self._decoding.popleft()
+            d = self._process(parsed, delivery)
+            d.addBoth(self._on_processed)
+
+    def _on_processed(self, ignored):
+        self._active -= 1
+        self._maybe_start_workers()
+
+    @inlineCallbacks
+    def _process(self, parsed, delivery):
+        start = time.time()
+        try:
+            if isinstance(parsed, Failure):
+                parsed.raiseException()
+            dispatcher = self.dispatchers[delivery.event]
+            key = _get_pull_request_key(delivery.event, parsed)
+            if key:
+                yield self.lanes.run(key, dispatcher, parsed)
+            else:
+                yield dispatcher(parsed)
+        except Exception:
+            metrics.increment("github.queue.errors")
+            print("Exception while processing %r webhook" % delivery.event)
+            traceback.print_exc()
+            succeeded = False
+        else:
+            succeeded = True
+        metrics.record_timing(
+            "github.dispatch." + delivery.event, time.time() - start)
+
+        if delivery.delivery_id and self.deliveries is not None:
+            if succeeded:
+                self.deliveries.confirm(delivery.delivery_id)
+            else:
+                # forget it so that redelivering it from github can retry
+                self.deliveries.discard(delivery.delivery_id)
+
+
+class DeliveryCache(object):
+    """Remembers recently seen delivery IDs so redeliveries can be ignored.
+
+    GitHub redelivers webhooks when it thinks we timed out and whenever
+    someone hits the redeliver button. Entries expire after a TTL and the
+    least recently seen are evicted beyond a maximum size. If given a
+    database, the IDs of deliveries that were handled successfully are also
+    persisted there so that they survive restarts.
+
+    """
+
+    def __init__(self, size, ttl, database=None):
+        self.size = size
+        self.ttl = ttl
+        self.database = database
+        self._seen = collections.OrderedDict()
+
+        metrics.register_gauge("github.deliveries.cached", lambda: len(self._seen))
+
+        if self.database:
+            self._pruner = task.LoopingCall(self._prune_database)
+            self._pruner.start(self.ttl, now=False)
+
+    def __contains__(self, delivery_id):
+        try:
+            seen_at = self._seen.pop(delivery_id)
+        except KeyError:
+            return False
+
+        if time.time() - seen_at > self.ttl:
+            return False
+
+        self._seen[delivery_id] = seen_at
+        metrics.increment("github.deliveries.duplicate")
+        return True
+
+    def add(self, delivery_id):
+        """Remember a delivery that's been accepted for processing.
+
+        Redeliveries of it are ignored from now on, even while it's still
+        queued. It's only persisted once it's been confirmed.
+
+        """
+        self._remember(delivery_id, time.time())
+        metrics.increment("github.deliveries.new")
+
+    def confirm(self, delivery_id):
+        "Record that a delivery was handled successfully."
+        if self.database:
+            d = self.database.runOperation(
+                "INSERT OR IGNORE INTO github_deliveries (id, received) VALUES (?, ?)",
+                (delivery_id, datetime.datetime.utcnow()),
+            )
+            d.addErrback(self._log_failure)
+
+    def discard(self, delivery_id):
+        "Forget a delivery that failed so that it can be redelivered."
+        self._seen.pop(delivery_id, None)
+
+    def _remember(self, delivery_id, seen_at):
+        self._seen.pop(delivery_id, None)
+        self._seen[delivery_id] = seen_at
+        while len(self._seen) > self.size:
+            self._seen.popitem(last=False)
+
+    @inlineCallbacks
+    def load(self):
+        if not self.database:
+            return
+
+        yield self._prune_database()
+        rows = yield self.database.runQuery(
+            "SELECT id FROM github_deliveries ORDER BY received")
+
+        # we don't bother parsing the stored timestamps, entries from the
+        # database just get a fresh TTL starting now.
+        now = time.time()
+        for delivery_id, in rows:
+            self._remember(delivery_id, now)
+
+    def _prune_database(self):
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.ttl)
+        d = self.database.runOperation(
+            "DELETE FROM github_deliveries WHERE received < ?", (cutoff,))
+        d.addErrback(self._log_failure)
+        return d
+
+    def _log_failure(self, failure):
+        print("Failed to persist github delivery IDs: %s" % failure.getErrorMessage())
+
+
 class GitHubListener(ProtectedResource):
     isLeaf = True
 
-    def __init__(self, http, bot, salons, database):
+    def __init__(self, http, bot, salons, database, queue_size=1000,
+                 workers=4, max_lanes=4, retry_after=60, deliveries=None,
+                 journal=None, offload=None, offload_threshold=None):
         ProtectedResource.__init__(self, http)
 
         self.salons = salons
+        self.retry_after = retry_after
+        self.deliveries = deliveries
+        self.journal = journal
 
         push_dispatcher = PushDispatcher(bot, salons)
         salon = Salon(bot, salons, database)
@@ -646,15 +1153,40 @@ class GitHubListener(ProtectedResource):
             "issue_comment": salon.dispatch_comment,
             "pull_request_review": salon.dispatch_review,
         }
+        self.queue = WebhookQueue(
+            self.dispatchers, queue_size, workers, OrderedLanes(max_lanes),
+            offload=offload, offload_threshold=offload_threshold,
+            deliveries=deliveries)
 
     def _handle_request(self, request):
+        if self.journal:
+            request.content.seek(0)
+            headers = {name: values[-1] for name, values
+                       in request.requestHeaders.getAllRawHeaders()}
+            self.journal.append(headers, request.content.read())
+
         event = request.requestHeaders.getRawHeaders("X-Github-Event")[-1]
-        dispatcher = self.dispatchers.get(event)
+        if event not in self.dispatchers:
+            return
+
+        delivery_id = request.getHeader("X-GitHub-Delivery")
+        if delivery_id and self.deliveries is not None:
+            if delivery_id in self.deliveries:
+                # we've already got this one, acknowledge it and move on
+                return "duplicate delivery"
 
-        if dispatcher:
-            post_data = request.args['payload'][0]
-            parsed = json.loads(post_data)
-            dispatcher(parsed)
+        try:
+            self.queue.put(event, _get_payload(request), delivery_id)
+        except WebhookQueueFullError:
+            # shed load and let github redeliver once we've caught up
+            request.setResponseCode(503)
+            request.setHeader("Retry-After", str(self.retry_after))
+            return
+
+        if delivery_id and self.deliveries is not None:
+            self.deliveries.add(delivery_id)
+
+        request.setResponseCode(202)
 
     @inlineCallbacks
     def claim_github_username(self, irc, sender, channel, github_username):
@@ -667,8 +1199,59 @@ class GitHubListener(ProtectedResource):
         irc.send_message(channel, "@%s: ok, i won't remap your name anymore" % (sender,))
 
 
-def make_plugin(http, irc, salons, database=None):
-    listener = GitHubListener(http, irc.bot, salons, database)
+def make_plugin(app_config, http, irc, salons, database=None):
+    github_config = config.parse_config(app_config, {
+        "queue_size": config.Optional(config.Integer, default=1000),
+        "workers": config.Optional(config.Integer, default=4),
+        "max_lanes": config.Optional(config.Integer, default=4),
+        "retry_after": config.Optional(
+            config.Timespan, default=datetime.timedelta(minutes=1)),
+        "dedupe_size": config.Optional(config.Integer, default=10000),
+        "dedupe_ttl": config.Optional(
+            config.Timespan, default=datetime.timedelta(days=1)),
+        "dedupe_persist": config.Optional(config.Boolean, default=False),
+        "journal_directory": config.Optional(config.String),
+        "journal_max_file_size": config.Optional(
+            config.Integer, default=64 * 1024 * 1024),
+        "offload_processes": config.Optional(config.Integer, default=0),
+        "offload_threshold": config.Optional(
+            config.Integer, default=1024 * 1024),
+        "offload_timeout": config.Optional(
+            config.Timespan, default=datetime.timedelta(minutes=1)),
+    })
+
+    deliveries = DeliveryCache(
+        size=github_config.dedupe_size,
+        ttl=github_config.dedupe_ttl.total_seconds(),
+        database=database if github_config.dedupe_persist else None,
+    )
+    deliveries.load()
+
+    journal = None
+    if github_config.journal_directory:
+        journal = JournalWriter(
+            github_config.journal_directory,
+            max_file_size=github_config.journal_max_file_size,
+        )
+
+    offload = None
+    if github_config.offload_processes:
+        offload = ProcessPool(
+            github_config.offload_processes,
+            timeout=github_config.offload_timeout.total_seconds(),
+        )
+
+    listener = GitHubListener(
+        http, irc.bot, salons, database,
+        queue_size=github_config.queue_size,
+        workers=github_config.workers,
+        max_lanes=github_config.max_lanes,
+        retry_after=int(github_config.retry_after.total_seconds()),
+        deliveries=deliveries,
+        journal=journal,
+        offload=offload,
+        offload_threshold=github_config.offload_threshold,
+    )
 
     http.root.putChild('github', listener)
     irc.register_command(listener.claim_github_username)
@@ -1,5 +1,7 @@
+import functools
 import hashlib
 import hmac
+import json
 import urlparse
 
 from baseplate import config
@@ -8,6 +10,7 @@ from twisted.application import internet
 from twisted.internet import reactor
 from twisted.internet.endpoints import serverFromString
 
+from harold import metrics
 from harold.utils import constant_time_compare
 
 
@@ -21,30 +24,89 @@ class AuthenticationError(Exception):
     pass
 
 
+# signature headers we understand, in order of preference
+_SIGNATURE_HEADERS = [
+    ("X-Hub-Signature-256", "sha256"),
+    ("X-Hub-Signature", "sha1"),
+]
+_DIGESTS = {
+    "sha1": hashlib.sha1,
+    "sha256": hashlib.sha256,
+}
+
+
+class SigningRequest(server.Request):
+    """A request that computes HMACs of its body while it's streamed in.
+
+    This saves reading the whole body back out of request.content again just
+    to authenticate it.
+
+    """
+
+    def __init__(self, hmac_secret, *args, **kwargs):
+        server.Request.__init__(self, *args, **kwargs)
+        self._hmac_secret = hmac_secret
+        self.body_hmacs = {}
+
+    def gotLength(self, length):
+        server.Request.gotLength(self, length)
+
+        # the headers are all in by now, so only the signature that's
+        # actually going to be checked needs computing.
+        if not self._hmac_secret:
+            return
+        for header_name, algorithm in _SIGNATURE_HEADERS:
+            if self.requestHeaders.hasHeader(header_name):
+                self.body_hmacs[algorithm] = hmac.new(
+                    self._hmac_secret, digestmod=_DIGESTS[algorithm])
+                break
+
+    def handleContentChunk(self, data):
+        for body_hmac in self.body_hmacs.itervalues():
+            body_hmac.update(data)
+        server.Request.handleContentChunk(self, data)
+
+
+def _get_body_hmac(request, secret, algorithm):
+    try:
+        return request.body_hmacs[algorithm].hexdigest()
+    except (AttributeError, KeyError):
+        request.content.seek(0)
+        body = request.content.read()
+        return hmac.new(secret, body, _DIGESTS[algorithm]).hexdigest()
+
+
 class ProtectedResource(resource.Resource):
     def __init__(self, http):
         self.http = http
 
     def _authenticate_request(self, request):
-        HEADER_NAME = "X-Hub-Signature"
-        has_signature = request.requestHeaders.hasHeader(HEADER_NAME)
-        if self.http.hmac_secret and has_signature:
-            # modern method: hmac of request body
-            body = request.content.read()
-            expected_hash = hmac.new(
-                self.http.hmac_secret, body, hashlib.sha1).hexdigest()
-
-            header = request.requestHeaders.getRawHeaders(HEADER_NAME)[0]
-            hashes = urlparse.parse_qs(header)
-            actual_hash = hashes["sha1"][0]
-
-            if not constant_time_compare(expected_hash, actual_hash):
-                raise AuthenticationError
+        if not self.http.hmac_secret:
+            raise AuthenticationError
+
+        for header_name, algorithm in _SIGNATURE_HEADERS:
+            if request.requestHeaders.hasHeader(header_name):
+                break
         else:
             # no further authentication methods
             raise AuthenticationError
 
+        # modern method: hmac of request body
+        expected_hash = _get_body_hmac(
+            request, self.http.hmac_secret, algorithm)
+
+        header = request.requestHeaders.getRawHeaders(header_name)[0]
+        hashes = urlparse.parse_qs(header)
+        try:
+            actual_hash = hashes[algorithm][0]
+        except KeyError:
+            raise AuthenticationError
+
+        if not constant_time_compare(expected_hash, actual_hash):
+            raise AuthenticationError
+
     def render_GET(self, request):
+        response = None
         try:
             self._authenticate_request(request)
         except AuthenticationError:
@@ -55,6 +117,7 @@ class ProtectedResource(resource.Resource):
         return response or ""
 
     def render_POST(self, request):
+        response = None
         try:
             self._authenticate_request(request)
         except AuthenticationError:
@@ -65,6 +128,14 @@ class ProtectedResource(resource.Resource):
         return response or ""
 
 
+class MetricsListener(ProtectedResource):
+    isLeaf = True
+
+    def _handle_request(self, request):
+        request.setHeader("Content-Type", "application/json")
+        return json.dumps(metrics.snapshot())
+
+
 def make_plugin(application, app_config):
     http_config = config.parse_config(app_config, {
         "endpoint": config.String,
@@ -74,7 +145,8 @@ def make_plugin(application, app_config):
     root = resource.Resource()
     harold = resource.Resource()
     root.putChild('harold', harold)
-    site = server.Site(root)
+    site = server.Site(root, requestFactory=functools.partial(
+        SigningRequest, http_config.hmac_secret))
     site.noisy = False
     site.displayTracebacks = False
 
@@ -82,4 +154,6 @@ def make_plugin(application, app_config):
     service = internet.StreamServerEndpointService(endpoint, site)
     service.setServiceParent(application)
 
-    return HttpPlugin(harold, http_config.hmac_secret)
+    plugin = HttpPlugin(harold, http_config.hmac_secret)
+    harold.putChild('metrics', MetricsListener(plugin))
+    return plugin
@@ -1,8 +1,11 @@
 import collections
+import time
+
 import pytz
 
 from twisted.internet.defer import inlineCallbacks, returnValue
 
+from harold import metrics
 from harold.utils import (
     fmt_time,
     parse_time,
@@ -13,6 +16,11 @@ _Salon = collections.namedtuple("Salon", "name conch_emoji deploy_hours_start de
 _Repository = collections.namedtuple("Repository", "name salon branches_ format_ bundled_format_")
 
 
+# the users table is mirrored in memory and kept up to date as nicks are set.
+# it's reloaded this often anyway in case it was edited behind our back.
+NICK_CACHE_TTL = 300
+
+
 class WouldOrphanRepositoriesError(Exception):
     pass
 
@@ -24,22 +32,95 @@ class Salon(_Salon):
 
 
 class Repository(_Repository):
+    def __new__(cls, *args, **kwargs):
+        self = super(Repository, cls).__new__(cls, *args, **kwargs)
+        # checked on every push, so parsed just the once
+        if self.branches_:
+            self.branches = frozenset(self.branches_.split(","))
+        else:
+            self.branches = frozenset(["master"])
+        return self
+
     @property
     def channel(self):
         return "#" + self.salon.encode("utf-8")
 
-    @property
-    def branches(self):
-        if self.branches_:
-            return self.branches_.split(",")
-        else:
-            return ["master"]
-
 
 class SalonManagerPlugin(object):
     def __init__(self, database):
         self.database = database
 
+        # github username -> nick
+        self._nicks = {}
+        self._nicks_loaded = None
+        self._nicks_loading = None
+
+        metrics.register_gauge("salons.nicks.size", lambda: len(self._nicks))
+
+        # lowercased repository name -> Repository, or None if it needs
+        # (re)loading. the generation is bumped whenever it's invalidated so
+        # that a load which was already running doesn't put back stale data.
+        self._repositories = None
+        self._repositories_loading = None
+        self._repositories_generation = 0
+
+    @inlineCallbacks
+    def _load_repositories(self):
+        generation = self._repositories_generation
+        rows = yield self.database.runQuery(
+            "SELECT name, salon, branches, format, bundled_format FROM repositories"
+        )
+        if generation == self._repositories_generation:
+            self._repositories = {
+                repo.name.lower(): repo
+                for repo in (Repository(*row) for row in rows)}
+            metrics.increment("salons.repositories.reload")
+
+    def _on_repositories_loaded(self, result):
+        self._repositories_loading = None
+        return result
+
+    @inlineCallbacks
+    def _get_repositories(self):
+        while self._repositories is None:
+            d = self._repositories_loading
+            if d is None:
+                d = self._repositories_loading = self._load_repositories()
+                d.addBoth(self._on_repositories_loaded)
+            yield d
+        returnValue(self._repositories)
+
+    def invalidate_repositories(self):
+        "Forget the repository routing table so it's reloaded when next used."
+        self._repositories = None
+        self._repositories_generation += 1
+
+    @inlineCallbacks
+    def _load_nicks(self):
+        rows = yield self.database.runQuery(
+            "SELECT github_username, irc_nick FROM users")
+        self._nicks = {github_username: irc_nick
+                       for github_username, irc_nick in rows}
+        self._nicks_loaded = time.time()
+        metrics.increment("salons.nicks.reload")
+
+    def _on_nicks_loaded(self, result):
+        self._nicks_loading = None
+        return result
+
+    @inlineCallbacks
+    def _get_nicks(self):
+        stale = (self._nicks_loaded is None or
+                 time.time() - self._nicks_loaded > NICK_CACHE_TTL)
+        if stale:
+            # share a single reload between everyone who notices
+            d = self._nicks_loading
+            if d is None:
+                d = self._nicks_loading = self._load_nicks()
+                d.addBoth(self._on_nicks_loaded)
+            yield d
+        returnValue(self._nicks)
+
     @inlineCallbacks
     def get_salons(self):
         rows = yield self.database.runQuery(
@@ -106,49 +187,73 @@ class SalonManagerPlugin(object):
                 "UPDATE repositories SET salon = ? WHERE lower(name) = lower(?)",
                 (salon_name, repository_name),
             )
+        finally:
+            self.invalidate_repositories()
 
     @inlineCallbacks
     def remove_repository(self, salon_name, repository_name):
-        yield self.database.runOperation(
-            "DELETE FROM repositories WHERE lower(name) = lower(?) AND salon = ?",
-            (repository_name, salon_name),
-        )
+        try:
+            yield self.database.runOperation(
+                "DELETE FROM repositories WHERE lower(name) = lower(?) AND salon = ?",
+                (repository_name, salon_name),
+            )
+        finally:
+            self.invalidate_repositories()
 
     @inlineCallbacks
     def get_repository(self, repository_name):
-        rows = yield self.database.runQuery(
-            "SELECT name, salon, branches, format, bundled_format FROM repositories WHERE lower(name) = lower(?)",
-            (repository_name,),
-        )
-
-        if rows:
-            repo = Repository(*rows[0])
-            returnValue(repo)
-        else:
-            returnValue(None)
+        repositories = yield self._get_repositories()
+        returnValue(repositories.get(repository_name.lower()))
 
     @inlineCallbacks
     def get_salon_repositories(self, salon_name):
-        rows = yield self.database.runQuery(
-            "SELECT name, salon, branches, format, bundled_format FROM repositories WHERE salon = ?",
-            (salon_name,),
-        )
-
-        repos = []
-        for row in rows:
-            repos.append(Repository(*row))
-        returnValue(repos)
+        repositories = yield self._get_repositories()
+        returnValue([repo for repo in repositories.itervalues()
+                     if repo.salon == salon_name])
 
     @inlineCallbacks
     def get_nick_for_user(self, github_username):
-        rows = yield self.database.runQuery(
-            "SELECT irc_nick FROM users WHERE github_username = ?",
-            (github_username.lower(),),
-        )
+        nicks = yield self.get_nicks_for_users([github_username])
+        returnValue(nicks[github_username])
+
+    @inlineCallbacks
+    def get_nicks_for_users(self, github_usernames):
+        """Resolve any number of github usernames to chat nicks at once.
+
+        Returns a dict keyed by the usernames as given. Anyone without a nick
+        on file maps to their github username.
 
-        if not rows:
-            returnValue("@" + github_username)
-        returnValue("@" + rows[0][0])
+        """
+        start = time.time()
+        nicks = yield self._get_nicks()
+
+        result = {}
+        for github_username in github_usernames:
+            nick = nicks.get(github_username.lower())
+            if nick is None:
+                metrics.increment("salons.nicks.misses")
+                result[github_username] = "@" + github_username
+            else:
+                metrics.increment("salons.nicks.hits")
+                result[github_username] = "@" + nick
+        metrics.record_timing("salons.nicks.lookup", time.time() - start)
+        returnValue(result)
+
+    @inlineCallbacks
+    def _update_nick(self, irc_nick, github_username):
+        if self._nicks_loading is not None:
+            # the reload may have read the table before our change, so apply
+            # it on top of whatever it comes back with.
+            try:
+                yield self._nicks_loading
+            except Exception:
+                pass
+
+        for username, nick in self._nicks.items():
+            if nick == irc_nick:
+                del self._nicks[username]
+        if github_username:
+            self._nicks[github_username] = irc_nick
 
     @inlineCallbacks
     def set_nick_for_user(self, irc_nick, github_username):
@@ -165,11 +270,13 @@ class SalonManagerPlugin(object):
                     "UPDATE users SET github_username = ? WHERE irc_nick = ?",
                     (github_username.lower(), irc_nick.lower()),
                 )
+            yield self._update_nick(irc_nick.lower(), github_username.lower())
         else:
             yield self.database.runOperation(
                 "DELETE FROM users WHERE irc_nick = ?",
                 (irc_nick.lower(),),
             )
+            yield self._update_nick(irc_nick.lower(), None)
 
     @inlineCallbacks
     def set_deploy_hours(self, name, start, end, tz):
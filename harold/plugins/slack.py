@@ -1,6 +1,11 @@
 import collections
+import datetime
+import errno
+import gzip
 import json
+import os
 import re
+import time
 import traceback
 import urllib
 
@@ -11,13 +16,22 @@ from autobahn.twisted.websocket import (
 from baseplate import config
 from twisted.application.internet import ClientService
 from twisted.internet import reactor
-from twisted.internet.defer import succeed, inlineCallbacks, returnValue, Deferred
+from twisted.internet.defer import (
+    succeed,
+    inlineCallbacks,
+    returnValue,
+    Deferred,
+    DeferredList,
+    fail,
+)
 from twisted.internet.endpoints import clientFromString
+from twisted.internet.threads import deferToThread
 from twisted.internet.interfaces import IStreamClientEndpoint
 from twisted.web.client import Agent, HTTPConnectionPool, readBody
 from twisted.web.http_headers import Headers
 from zope.interface import implementer
 
+from harold import metrics
 from harold.handlers import Handlers, NoHandlerError
 
 
@@ -55,6 +69,12 @@ class SlackWebClientResponseError(SlackWebClientError):
             "%r: %r" % (self.code, self.args))
 
 
+class SlackWebClientBacklogError(SlackWebClientError):
+    def __init__(self, method):
+        super(SlackWebClientBacklogError, self).__init__(
+            "dropped %s request, outbound backlog is full" % method)
+
+
 class SlackWebClientRatelimitedError(SlackWebClientError):
     def __init__(self, retry_after):
         self.retry_after = retry_after
@@ -62,40 +82,261 @@ class SlackWebClientRatelimitedError(SlackWebClientError):
             "ratelimited: retry_after=%d" % self.retry_after)
 
 
-QueuedRequest = collections.namedtuple("QueuedRequest", "deferred params")
+class SlackWebClientTimeoutError(SlackWebClientError):
+    def __init__(self, method, deadline):
+        super(SlackWebClientTimeoutError, self).__init__(
+            "%s request took longer than %s seconds" % (method, deadline))
+
+
+class SlackWebClientServerError(SlackWebClientError):
+    def __init__(self, code):
+        self.code = code
+        super(SlackWebClientServerError, self).__init__(
+            "slack returned HTTP %d" % code)
+
+
+class SlackWebClientUnavailableError(SlackWebClientError):
+    def __init__(self, method):
+        super(SlackWebClientUnavailableError, self).__init__(
+            "not sending %s request, slack looks to be down" % method)
+
+
+# outbound requests are sent highest priority first. when the backlog is too
+# long, the lowest priority requests are dropped first.
+PRIORITIES = ("high", "normal", "low")
+
+
+QueuedRequest = collections.namedtuple(
+    "QueuedRequest", "deferred method params priority queued")
+
+
+# slack's documented web api rate limit tiers, in requests per minute. a
+# bucket holds a tenth of a minute's allowance so short bursts go straight
+# through but a sustained flood is paced out to the tier's rate.
+_TIER_1 = 1
+_TIER_2 = 20
+_TIER_3 = 50
+_TIER_4 = 100
+_METHOD_TIERS = {
+    "auth.test": _TIER_4,
+    "conversations.list": _TIER_2,
+    "conversations.setTopic": _TIER_2,
+    "rtm.connect": _TIER_1,
+    "users.list": _TIER_2,
+}
+_DEFAULT_TIER = _TIER_3
+
+# chat.postMessage isn't tiered. slack allows about one message per second
+# per channel with short bursts.
+_POST_MESSAGE_RATE = 1.
+_POST_MESSAGE_BURST = 3
+
+
+# how long a request may take, including reading the response, before it's
+# abandoned. anything not listed gets the client's default.
+_METHOD_DEADLINES = {
+    "conversations.list": 30,
+    "users.list": 30,
+}
+
+
+class CircuitBreaker(object):
+    """Stop trying a service that's failing, and check back now and then.
+
+    After enough consecutive failures the circuit opens and everything is
+    refused without being tried. Once reset_timeout has passed, one request
+    at a time is let through as a probe: if it succeeds the circuit closes
+    again, otherwise it stays open for another reset_timeout.
+
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened = None
+        self._probing = False
+
+    def allow(self):
+        if self.state == self.OPEN:
+            if time.time() - self._opened < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+
+        if self.state == self.HALF_OPEN:
+            if self._probing:
+                return False
+            self._probing = True
+        return True
+
+    def succeeded(self):
+        self._failures = 0
+        self._probing = False
+        if self.state != self.CLOSED:
+            print("Slack is reachable again, closing circuit.")
+            metrics.increment("slack.circuit.closed")
+        self.state = self.CLOSED
+
+    def failed(self):
+        self._failures += 1
+        self._probing = False
+        if (self.state == self.HALF_OPEN or
+                self._failures >= self.failure_threshold):
+            if self.state == self.CLOSED:
+                print("Too many failed Slack requests, opening circuit.")
+                metrics.increment("slack.circuit.opened")
+            self.state = self.OPEN
+            self._opened = time.time()
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.time()
+
+    def _refill(self, now):
+        # _updated is in the future while we're being penalized
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+            self._updated = now
+
+    def level(self):
+        self._refill(time.time())
+        return self._tokens
+
+    def delay(self):
+        "Return how long until a token will be available."
+        now = time.time()
+        self._refill(now)
+        delay = max(0., self._updated - now)
+        if self._tokens < 1:
+            delay += (1 - self._tokens) / self.rate
+        return delay
+
+    def consume(self):
+        self._refill(time.time())
+        self._tokens -= 1
+
+    def penalize(self, seconds):
+        "Hand out nothing new for a while, e.g. after slack says to back off."
+        now = time.time()
+        self._refill(now)
+        self._tokens = min(self._tokens, 0.)
+        self._updated = max(self._updated, now + seconds)
 
 
 class SlackWebClient(object):
-    def __init__(self, token):
+    """A Slack Web API client that paces its requests.
+
+    Requests are queued by priority and, within a priority, round-robin
+    between channels (or, for anything but chat.postMessage, between
+    methods) so that one busy channel can't starve the others. Each is sent
+    as soon as the rate limit buckets it's subject to allow and one of the
+    max_connections connections to slack is free.
+
+    Requests that take longer than their deadline are cancelled. If slack
+    keeps failing, a circuit breaker refuses requests outright until it
+    seems to have recovered.
+
+    """
+
+    def __init__(self, token, max_backlog=1000, max_connections=8,
+                 request_timeout=10, circuit_failures=5, circuit_reset=30):
         self._pool = HTTPConnectionPool(reactor)
+        self._pool.maxPersistentPerHost = max_connections
         self._token = token
-        self._queues = collections.defaultdict(list)
-        self._retry_timers = {}
+        self._max_backlog = max_backlog
+        self._max_connections = max_connections
+        self._request_timeout = request_timeout
+        self._in_flight = 0
+        self._breaker = CircuitBreaker(circuit_failures, circuit_reset)
+        self._method_buckets = {}
+        self._channel_buckets = {}
+
+        # priority -> lane key -> deque of requests. the order of the lanes
+        # within a priority is the round-robin order.
+        self._backlog = {
+            priority: collections.OrderedDict() for priority in PRIORITIES}
+        self._backlog_size = 0
+        self._pump_timer = None
+        # (priority, lane key) -> when the head of that lane was first held
+        # back by its rate limit bucket
+        self._throttled = {}
 
         self._pool._factory.noisy = False
 
-    @inlineCallbacks
-    def make_request(self, method, **params):
-        if not self._retry_timers.get(method):
-            try:
-                response = yield self._make_request(method, **params)
-                returnValue(response)
-            except SlackWebClientRatelimitedError as exc:
-                print("Slack ratelimit hit for %r, retrying in %d seconds." %
-                      (method, exc.retry_after))
-                self._schedule_retry_timer(method, exc.retry_after)
-
-        # either we were already blocked on ratelimit or we just got a
-        # ratelimit response, so we'll queue up this request to be tried when
-        # it's OK to do so.
+        metrics.register_gauge("slack.ratelimit.methods", lambda: {
+            method: bucket.level()
+            for method, bucket in self._method_buckets.iteritems()})
+        metrics.register_gauge("slack.ratelimit.channels", lambda: {
+            channel: bucket.level()
+            for channel, bucket in self._channel_buckets.iteritems()})
+        metrics.register_gauge("slack.queue.depth", lambda: {
+            priority: sum(len(lane) for lane in lanes.itervalues())
+            for priority, lanes in self._backlog.iteritems()})
+        metrics.register_gauge("slack.http.connections", lambda: {
+            "in_use": self._in_flight,
+            "idle": sum(len(connections)
+                        for connections in self._pool._connections.itervalues()),
+        })
+        metrics.register_gauge("slack.circuit.state", lambda: self._breaker.state)
+
+    def _get_lane_key(self, method, params):
+        if method == "chat.postMessage":
+            return params.get("channel")
+        return method
+
+    def _get_bucket_name(self, method, params):
+        if method == "chat.postMessage":
+            return "channels.%s" % params.get("channel")
+        return "methods." + method
+
+    def _get_buckets(self, method, params):
+        buckets = []
+
+        if method == "chat.postMessage":
+            channel = params.get("channel")
+            bucket = self._channel_buckets.get(channel)
+            if bucket is None:
+                bucket = self._channel_buckets[channel] = TokenBucket(
+                    _POST_MESSAGE_RATE, _POST_MESSAGE_BURST)
+            buckets.append(bucket)
+        else:
+            bucket = self._method_buckets.get(method)
+            if bucket is None:
+                per_minute = _METHOD_TIERS.get(method, _DEFAULT_TIER)
+                bucket = self._method_buckets[method] = TokenBucket(
+                    per_minute / 60., max(1, per_minute // 10))
+            buckets.append(bucket)
+
+        return buckets
+
+    def make_request(self, method, priority="normal", **params):
+        if priority not in PRIORITIES:
+            raise ValueError("unknown priority: %r" % priority)
+
         d = Deferred()
-        request = QueuedRequest(d, params)
-        self._queues[method].append(request)
-        response = yield d
-        returnValue(response)
+        self._enqueue(QueuedRequest(d, method, params, priority, time.time()))
+        self._pump()
+        return d
 
     @inlineCallbacks
-    def make_paginated_request(self, method, paginated_field, **params):
+    def make_paginated_request(self, method, paginated_field, priority="normal",
+                               transform=None, **params):
+        """Fetch every page of a paginated method.
+
+        If given, transform is applied to each item as its page arrives so
+        that only the transformed items are held on to.
+
+        """
         paginated_params = {}
         paginated_params.update(params)
         paginated_params["limit"] = 200
@@ -103,9 +344,13 @@ class SlackWebClient(object):
         results = []
 
         while True:
-            response = yield self.make_request(method, **paginated_params)
+            response = yield self.make_request(
+                method, priority=priority, **paginated_params)
 
-            results.extend(response[paginated_field])
+            if transform:
+                results.extend(transform(item) for item in response[paginated_field])
+            else:
+                results.extend(response[paginated_field])
 
             next_cursor = response.get("response_metadata", {}).get("next_cursor")
             if not next_cursor:
@@ -114,34 +359,149 @@ class SlackWebClient(object):
 
         returnValue(results)
 
-    def _schedule_retry_timer(self, method, retry_after):
-        current_timer = self._retry_timers.get(method)
-        if current_timer and current_timer.active():
-            current_timer.cancel()
+    def _enqueue(self, request, retry=False):
+        lanes = self._backlog[request.priority]
+        key = self._get_lane_key(request.method, request.params)
+        lane = lanes.get(key)
+        if lane is None:
+            lane = lanes[key] = collections.deque()
+
+        if retry:
+            lane.appendleft(request)
+        else:
+            lane.append(request)
+        self._backlog_size += 1
+
+        while self._backlog_size > self._max_backlog:
+            self._shed()
+
+    def _shed(self):
+        # drop the oldest request from the longest lane of the lowest
+        # priority that has anything queued at all.
+        for priority in reversed(PRIORITIES):
+            lanes = self._backlog[priority]
+            if lanes:
+                break
 
-        timer = reactor.callLater(retry_after, self._drain_queue, method)
-        self._retry_timers[method] = timer
+        key = max(lanes, key=lambda k: len(lanes[k]))
+        lane = lanes[key]
+        request = lane.popleft()
+        if not lane:
+            del lanes[key]
+        self._backlog_size -= 1
+        self._throttled.pop((priority, key), None)
+
+        metrics.increment("slack.queue.shed." + priority)
+        request.deferred.errback(SlackWebClientBacklogError(request.method))
+
+    def _pump(self):
+        if self._pump_timer and self._pump_timer.active():
+            self._pump_timer.cancel()
+        self._pump_timer = None
+
+        next_delay = None
+        while self._in_flight < self._max_connections:
+            request, next_delay = self._pop_ready_request()
+            if not request:
+                break
+            self._send(request)
+
+        # if every connection is busy, the next one to finish pumps again
+        if next_delay is not None and self._in_flight < self._max_connections:
+            self._pump_timer = reactor.callLater(next_delay, self._pump)
+
+    def _pop_ready_request(self):
+        """Take the next request that may be sent right now.
+
+        Only the head of each lane is considered so that requests to the same
+        channel are sent in order. If nothing is ready, returns how long until
+        something will be.
+
+        """
+        next_delay = None
+        for priority in PRIORITIES:
+            lanes = self._backlog[priority]
+            for key, lane in lanes.iteritems():
+                request = lane[0]
+                buckets = self._get_buckets(request.method, request.params)
+                delay = max(bucket.delay() for bucket in buckets)
+                if delay:
+                    self._throttled.setdefault((priority, key), time.time())
+                    if next_delay is None or delay < next_delay:
+                        next_delay = delay
+                    continue
+
+                for bucket in buckets:
+                    bucket.consume()
+
+                throttled = self._throttled.pop((priority, key), None)
+                waited = time.time() - throttled if throttled else 0.
+                bucket_name = self._get_bucket_name(request.method, request.params)
+                metrics.record_timing("slack.ratelimit.wait", waited)
+                metrics.record_timing("slack.ratelimit.wait." + bucket_name, waited)
+
+                # move this lane to the back of the round-robin order
+                del lanes[key]
+                lane.popleft()
+                if lane:
+                    lanes[key] = lane
+                self._backlog_size -= 1
+                return request, None
+        return None, next_delay
 
     @inlineCallbacks
-    def _drain_queue(self, method):
-        self._retry_timers[method] = None
-
-        queue = self._queues[method]
-        while queue:
-            request = queue[0]
-
-            try:
-                response = yield self._make_request(method, **request.params)
-                request.deferred.callback(response)
-            except SlackWebClientRatelimitedError as exc:
-                print("Slack ratelimit hit for %r while flushing backlog, %d left in queue." %
-                      (method, len(queue)))
-                self._schedule_retry_timer(method, exc.retry_after)
-                break
-            except SlackWebClientError as exc:
-                request.deferred.errback(exc)
+    def _attempt(self, request):
+        if not self._breaker.allow():
+            metrics.increment("slack.circuit.refused")
+            raise SlackWebClientUnavailableError(request.method)
+
+        deadline = _METHOD_DEADLINES.get(request.method, self._request_timeout)
+        self._in_flight += 1
+        try:
+            response = yield self._make_request(
+                request.method, **request.params
+            ).addTimeout(deadline, reactor, onTimeoutCancel=(
+                lambda result, timeout: fail(
+                    SlackWebClientTimeoutError(request.method, timeout))))
+        except (SlackWebClientResponseError, SlackWebClientRatelimitedError):
+            # slack answered, so it's up even if it didn't like the request
+            self._breaker.succeeded()
+            raise
+        except Exception:
+            self._breaker.failed()
+            raise
+        else:
+            self._breaker.succeeded()
+            returnValue(response)
+        finally:
+            self._in_flight -= 1
+            self._pump()
+
+    @inlineCallbacks
+    def _send(self, request):
+        metrics.record_timing(
+            "slack.queue.wait." + request.priority, time.time() - request.queued)
 
-            queue.pop(0)
+        try:
+            response = yield self._attempt(request)
+        except SlackWebClientTimeoutError:
+            metrics.increment("slack.timeouts." + request.method)
+            request.deferred.errback()
+        except SlackWebClientRatelimitedError as exc:
+            print("Slack ratelimit hit for %r, retrying in %d seconds." %
+                  (request.method, exc.retry_after))
+            metrics.increment("slack.ratelimited." + request.method)
+            for bucket in self._get_buckets(request.method, request.params):
+                bucket.penalize(exc.retry_after)
+
+            # try again as soon as we're allowed, ahead of anything that was
+            # queued up behind it.
+            self._enqueue(request, retry=True)
+            self._pump()
+        except Exception:
+            request.deferred.errback()
+        else:
+            request.deferred.callback(response)
 
     @inlineCallbacks
     def _make_request(self, method, **params):
@@ -162,6 +522,8 @@ class SlackWebClient(object):
             body_producer,
         )
         body = yield readBody(response)
+        if response.code >= 500:
+            raise SlackWebClientServerError(response.code)
         data = json.loads(body)
 
         if response.code == 429:
@@ -187,7 +549,7 @@ class SlackEndpoint(object):
     @inlineCallbacks
     def connect(self, factory):
         print("Connecting to Slack RTM...")
-        data = yield self._api_client.make_request("rtm.connect")
+        data = yield self._api_client.make_request("rtm.connect", priority="high")
         url = data["url"]
 
         factory.setSessionParameters(url)
@@ -208,8 +570,7 @@ class SlackClientProtocol(WebSocketClientProtocol):
         if is_binary:
             return
 
-        payload = json.loads(raw_payload)
-        self.factory.onMessage(payload)
+        self.factory.onMessage(raw_payload)
 
 
 class SlackClientFactory(WebSocketClientFactory):
@@ -220,17 +581,54 @@ class SlackClientFactory(WebSocketClientFactory):
         self._plugin = plugin
         super(SlackClientFactory, self).__init__(**kwargs)
 
-    def onMessage(self, payload):
-        self._plugin._onMessage(payload)
+    def onMessage(self, raw_payload):
+        self._plugin._onFrame(raw_payload)
+
+
+# slack truncates anything much longer than this, so coalesced messages are
+# split up to stay under it.
+_MAX_MESSAGE_LENGTH = 4000
+
+
+class _MessageBatch(object):
+    def __init__(self):
+        self.messages = []
+        self.priority = PRIORITIES[-1]
+        self.waiting = []
+        self.timer = None
+
+    def add(self, message, priority):
+        self.messages.append(message)
+        if PRIORITIES.index(priority) < PRIORITIES.index(self.priority):
+            self.priority = priority
+
+        d = Deferred()
+        self.waiting.append(d)
+        return d
+
+    def chunks(self):
+        chunk = []
+        length = 0
+        for message in self.messages:
+            if chunk and length + 1 + len(message) > _MAX_MESSAGE_LENGTH:
+                yield "\n".join(chunk)
+                chunk = []
+                length = 0
+            length += len(message) + (1 if chunk else 0)
+            chunk.append(message)
+        if chunk:
+            yield "\n".join(chunk)
 
 
 class SlackBot(object):
-    USER_RE = re.compile("@([A-Za-z0-9._-]+)")
-    CHANNEL_RE = re.compile("(#[A-Za-z0-9_-]+)")
+    # user and channel mentions are rewritten in the same pass
+    MENTION_RE = re.compile("@([A-Za-z0-9._-]+)|#([A-Za-z0-9_-]+)")
 
-    def __init__(self, api_client, data_cache):
+    def __init__(self, api_client, data_cache, coalesce_window=0):
         self._api_client = api_client
         self._data_cache = data_cache
+        self._coalesce_window = coalesce_window
+        self._batches = {}
 
     @inlineCallbacks
     def set_topic(self, channel_name, topic):
@@ -243,48 +641,75 @@ class SlackBot(object):
         try:
             yield self._api_client.make_request(
                 "conversations.setTopic",
-                channel=channel["id"],
+                channel=channel.id,
                 topic=topic[:250],
             )
         except SlackWebClientError as exc:
             print("Failed while setting topic in %s: %s" % (channel_name, exc))
 
+    def send_message(self, channel_name, message, priority="normal"):
+        """Send a message to a channel.
+
+        If a coalescing window is configured, the message is held for that
+        long and posted together with any others for the same channel that
+        arrive in the meantime.
+
+        """
+        if not self._coalesce_window:
+            return self._post_message(channel_name, message, priority)
+
+        batch = self._batches.get(channel_name)
+        if batch is None:
+            batch = self._batches[channel_name] = _MessageBatch()
+            batch.timer = reactor.callLater(
+                self._coalesce_window, self._flush_batch, channel_name)
+        return batch.add(message, priority)
+
+    def _flush_batch(self, channel_name):
+        batch = self._batches.pop(channel_name)
+
+        # the chunks are all handed to the api client at once so that they
+        # queue up in order, ahead of whatever the next batch brings.
+        posts = [self._post_message(channel_name, chunk, batch.priority)
+                 for chunk in batch.chunks()]
+        metrics.increment("slack.coalesce.messages", len(batch.messages))
+        metrics.increment("slack.coalesce.posts", len(posts))
+
+        def notify_waiting(ignored):
+            for d in batch.waiting:
+                d.callback(None)
+        DeferredList(posts).addCallback(notify_waiting)
+
     @inlineCallbacks
-    def send_message(self, channel_name, message):
-        users = yield self._data_cache.get_users()
-        users_by_name = {u["name"]: u for u in users.itervalues()}
-        def replace_user_mention(m):
-            mentioned_name = m.group(1)
-            try:
-                user = users_by_name[mentioned_name]
-            except KeyError:
-                return mentioned_name
-
-            return "<@" + user["id"] + ">"
-        message = self.USER_RE.sub(replace_user_mention, message)
-
-        channels = yield self._data_cache.get_channels()
-        channels_by_name = {"#" + c["name"]: c for c in channels.itervalues()}
-        def replace_channel_mention(m):
-            mentioned_channel = m.group(1)
-            try:
-                channel = channels_by_name[mentioned_channel]
-            except KeyError:
-                return mentioned_channel
-
-            return "<#" + channel["id"] + ">"
-        message = self.CHANNEL_RE.sub(replace_channel_mention, message)
+    def _post_message(self, channel_name, message, priority):
+        users_by_name = yield self._data_cache.get_users_by_name()
+        channels_by_name = yield self._data_cache.get_channels_by_name()
 
         try:
-            channel = channels_by_name[channel_name]
+            channel = channels_by_name[channel_name.lstrip("#")]
         except KeyError:
             print("Attempted to send message to unknown channel: %s" % channel_name)
             return
 
+        def replace_mention(m):
+            mentioned_name, mentioned_channel = m.groups()
+            if mentioned_name:
+                try:
+                    return "<@" + users_by_name[mentioned_name].id + ">"
+                except KeyError:
+                    return mentioned_name
+            else:
+                try:
+                    return "<#" + channels_by_name[mentioned_channel].id + ">"
+                except KeyError:
+                    return m.group(0)
+        message = self.MENTION_RE.sub(replace_mention, message)
+
         try:
             yield self._api_client.make_request(
                 "chat.postMessage",
-                channel=channel["id"],
+                priority=priority,
+                channel=channel.id,
                 text=message,
                 as_user=True,
             )
@@ -292,36 +717,240 @@ class SlackBot(object):
             print("Failed while sending message to %s: %s" % (channel_name, exc))
 
 
+def _intern(value):
+    # ids and nearly all names are ascii. as interned byte strings they're a
+    # quarter the size of unicode ones and shared by every reference.
+    try:
+        return intern(value.encode("ascii"))
+    except UnicodeError:
+        return value
+
+
+class SlackUser(object):
+    """The parts of a Slack user that harold cares about.
+
+    Slack's user objects carry whole profiles, image URLs and the like,
+    which add up to many megabytes in a large workspace.
+
+    """
+    __slots__ = ("id", "name")
+
+    def __init__(self, id, name):
+        self.id = _intern(id)
+        self.name = _intern(name)
+
+    @classmethod
+    def from_api(cls, data):
+        return cls(data["id"], data["name"])
+
+
+class SlackChannel(object):
+    "The parts of a Slack channel that harold cares about."
+    __slots__ = ("id", "name")
+
+    def __init__(self, id, name):
+        self.id = _intern(id)
+        self.name = _intern(name)
+
+    @classmethod
+    def from_api(cls, data):
+        return cls(data["id"], data["name"])
+
+
+# bump this if the snapshot's layout changes so old ones are ignored
+_SNAPSHOT_VERSION = 1
+
+
 class SlackDataCache(object):
-    def __init__(self, api_client):
+    def __init__(self, api_client, snapshot_path=None, max_age=3600):
         self._api_client = api_client
+        self._snapshot_path = snapshot_path
+        self._max_age = max_age
+        self._refreshing = None
         self._wait_for_init = Deferred()
         self._self = {}
         self._users = {}
         self._channels = {}
 
+        # secondary indexes, kept in step with the above as changes come in
+        self._users_by_name = {}
+        self._channels_by_name = {}
+
+        # when the data we're serving was last fetched in full from slack
+        self._refreshed = None
+        # whether this process has done that fetch itself. a snapshot can't
+        # know who joined or was renamed while harold wasn't running.
+        self._fetched = False
+
+        metrics.register_gauge("slack.cache.age", self._get_age)
+
+        if self._snapshot_path:
+            self._load_snapshot()
+
+    def _get_age(self):
+        if self._refreshed is None:
+            return None
+        return time.time() - self._refreshed
+
+    def _rebuild_indexes(self):
+        self._users_by_name = {
+            u.name: u for u in self._users.itervalues()}
+        self._channels_by_name = {
+            c.name: c for c in self._channels.itervalues()}
+
+    def _load_snapshot(self):
+        start = time.time()
+        try:
+            with gzip.open(self._snapshot_path, "rb") as f:
+                snapshot = json.load(f)
+        except (IOError, EOFError, ValueError) as exc:
+            if getattr(exc, "errno", None) != errno.ENOENT:
+                print("Failed to load Slack snapshot: %s" % exc)
+            return
+
+        if snapshot.get("version") != _SNAPSHOT_VERSION:
+            return
+
+        self._self = snapshot["self"]
+        self._users = {}
+        for id, name in snapshot["users"]:
+            user = SlackUser(id, name)
+            self._users[user.id] = user
+        self._channels = {}
+        for id, name in snapshot["channels"]:
+            channel = SlackChannel(id, name)
+            self._channels[channel.id] = channel
+        self._rebuild_indexes()
+        self._refreshed = snapshot["saved"]
+
+        # there's something to serve now, so nobody needs to wait for slack
+        self._wait_for_init = None
+
+        metrics.record_timing("slack.cache.snapshot_load", time.time() - start)
+        print("Slack data cache loaded from snapshot (%d seconds old)." %
+              self._get_age())
+
+    def _save_snapshot(self):
+        # only what harold actually looks at is kept, which is a tiny
+        # fraction of what slack sends.
+        snapshot = {
+            "version": _SNAPSHOT_VERSION,
+            "saved": self._refreshed,
+            "self": {"user_id": self._self["user_id"], "user": self._self["user"]},
+            "users": [(u.id, u.name) for u in self._users.itervalues()],
+            "channels": [(c.id, c.name) for c in self._channels.itervalues()],
+        }
+        d = deferToThread(self._write_snapshot, snapshot)
+        d.addErrback(self._log_snapshot_failure)
+        return d
+
+    def _log_snapshot_failure(self, failure):
+        print("Failed to save Slack snapshot: %s" % failure.getErrorMessage())
+
+    def _write_snapshot(self, snapshot):
+        temp_path = self._snapshot_path + ".tmp"
+        with gzip.open(temp_path, "wb") as f:
+            json.dump(snapshot, f)
+        os.rename(temp_path, self._snapshot_path)
+
     @inlineCallbacks
     def initialize(self):
-        if not self._wait_for_init:
+        # if we have nothing to go on yet, everyone has to wait for this.
+        # otherwise they carry on with what we've got while it's refreshed.
+        if not self._wait_for_init and self._refreshed is None:
             self._wait_for_init = Deferred()
 
-        self._self = yield self._api_client.make_request("auth.test")
+        start = time.time()
+        self_info = yield self._api_client.make_request(
+            "auth.test", priority="high")
 
         users = yield self._api_client.make_paginated_request(
-            "users.list", "members")
-        for user in users:
-            self._users[user["id"]] = user
+            "users.list", "members", priority="high",
+            transform=SlackUser.from_api)
 
         channels = yield self._api_client.make_paginated_request(
-            "conversations.list", "channels",
-            exclude_members=True, exclude_archived=True,
+            "conversations.list", "channels", priority="high",
+            transform=SlackChannel.from_api, exclude_members=True, exclude_archived=True,
             types="public_channel")
-        for channel in channels:
-            self._channels[channel["id"]] = channel
+
+        self._self = self_info
+        self._users = {user.id: user for user in users}
+        self._channels = {channel.id: channel for channel in channels}
+        self._rebuild_indexes()
+        self._refreshed = time.time()
+        self._fetched = True
+        metrics.record_timing("slack.cache.reload", self._refreshed - start)
+
+        if self._snapshot_path:
+            self._save_snapshot()
 
         print("Slack data cache initialized.")
-        self._wait_for_init.callback(None)
-        self._wait_for_init = None
+        if self._wait_for_init:
+            self._wait_for_init.callback(None)
+            self._wait_for_init = None
+
+    @inlineCallbacks
+    def reconcile(self):
+        """Catch up on what might have been missed while disconnected.
+
+        The user list is by far the most expensive thing to fetch and is
+        kept up to date by user_change events while we're connected, so
+        only channels are refetched here. Users are picked up by the next
+        full refresh.
+
+        """
+        start = time.time()
+        channels = yield self._api_client.make_paginated_request(
+            "conversations.list", "channels", priority="high",
+            transform=SlackChannel.from_api, exclude_members=True, exclude_archived=True,
+            types="public_channel")
+
+        self._channels = {channel.id: channel for channel in channels}
+        self._channels_by_name = {
+            c.name: c for c in self._channels.itervalues()}
+        metrics.record_timing("slack.cache.reconcile", time.time() - start)
+
+        if self._snapshot_path:
+            self._save_snapshot()
+
+    def refresh(self):
+        """Bring the cache up to date after connecting to RTM.
+
+        The first refresh in a process is always a full reload, even if a
+        snapshot was loaded, and after that only once the cache is older
+        than max_age. Otherwise it's reconciled. Only one refresh runs at a
+        time, so a flurry of reconnects doesn't start a flurry of downloads.
+
+        """
+        if self._refreshing:
+            return self._refreshing
+
+        age = self._get_age()
+        if not self._fetched or age > self._max_age:
+            d = self.initialize()
+        else:
+            d = self.reconcile()
+
+        self._refreshing = d
+        d.addErrback(self._log_refresh_failure)
+        d.addBoth(self._on_refreshed)
+        return d
+
+    def _on_refreshed(self, result):
+        self._refreshing = None
+        return result
+
+    def _log_refresh_failure(self, failure):
+        print("Failed to refresh Slack data cache:")
+        failure.printTraceback()
+
+    def peek_self(self):
+        """Return what's known about harold's own user without waiting.
+
+        This is empty until the cache has been loaded for the first time.
+
+        """
+        return self._self
 
     @inlineCallbacks
     def get_self(self):
@@ -335,6 +964,12 @@ class SlackDataCache(object):
             yield self._wait_for_init
         returnValue(self._users)
 
+    @inlineCallbacks
+    def get_users_by_name(self):
+        if self._wait_for_init:
+            yield self._wait_for_init
+        returnValue(self._users_by_name)
+
     @inlineCallbacks
     def get_user_by_id(self, id):
         users = yield self.get_users()
@@ -346,6 +981,12 @@ class SlackDataCache(object):
             yield self._wait_for_init
         returnValue(self._channels)
 
+    @inlineCallbacks
+    def get_channels_by_name(self):
+        if self._wait_for_init:
+            yield self._wait_for_init
+        returnValue(self._channels_by_name)
+
     @inlineCallbacks
     def get_channel_by_id(self, id):
         channels = yield self.get_channels()
@@ -356,33 +997,64 @@ class SlackDataCache(object):
         if name.startswith("#"):
             name = name[1:]
 
-        channels = yield self.get_channels()
-        for channel in channels.itervalues():
-            if name == channel["name"]:
-                returnValue(channel)
-        returnValue(None)
+        channels_by_name = yield self.get_channels_by_name()
+        returnValue(channels_by_name.get(name))
+
+    def _unindex(self, index, name, entry):
+        # only drop the name if it still refers to this entry, another may
+        # have taken it over in the meantime.
+        if index.get(name) is entry:
+            del index[name]
 
     def onUserChange(self, payload):
-        user = payload["user"]
-        self._users[user["id"]] = user
+        user = SlackUser.from_api(payload["user"])
+
+        previous = self._users.get(user.id)
+        if previous is not None:
+            self._unindex(self._users_by_name, previous.name, previous)
+
+        self._users[user.id] = user
+        self._users_by_name[user.name] = user
 
     def onChannelChange(self, payload):
         event_type = payload["type"]
         channel = payload["channel"]
 
         if event_type == "channel_deleted":
-            del self._channels[channel]
+            previous = self._channels.pop(channel)
+            self._unindex(self._channels_by_name, previous.name, previous)
         elif event_type == "channel_created":
-            self._channels[channel["id"]] = channel
+            channel = SlackChannel.from_api(channel)
+            self._channels[channel.id] = channel
+            self._channels_by_name[channel.name] = channel
         elif event_type == "channel_rename":
-            self._channels[channel["id"]]["name"] = channel["name"]
+            existing = self._channels[channel["id"]]
+            self._unindex(self._channels_by_name, existing.name, existing)
+            existing.name = _intern(channel["name"])
+            self._channels_by_name[existing.name] = existing
+
+
+# the rtm stream carries every event in the workspace, most of which harold
+# ignores. these are matched against the raw frame so that uninteresting ones
+# can be dropped without decoding them. nested objects carry "type" keys too,
+# so a match only means the frame *might* be interesting; the decoded payload
+# has the final say.
+_HANDLED_EVENT_RE = re.compile(
+    r'"type"\s*:\s*"(message|user_change|channel_[a-z_]+|hello)"')
+_EVENT_TYPE_RE = re.compile(r'"type"\s*:\s*"([A-Za-z0-9_]+)"')
 
 
 class SlackPlugin(object):
-    def __init__(self, api_client):
+    def __init__(self, api_client, coalesce_window=0, snapshot_path=None,
+                 cache_max_age=3600):
         self._handlers = Handlers()
-        self._data_cache = SlackDataCache(api_client)
-        self._bot = SlackBot(api_client, self._data_cache)
+        self._data_cache = SlackDataCache(
+            api_client, snapshot_path=snapshot_path, max_age=cache_max_age)
+        self._connected_before = False
+        self._bot = SlackBot(
+            api_client, self._data_cache, coalesce_window=coalesce_window)
+        self._mention_re = None
+        self._mention_re_key = None
 
     @property
     def bot(self):
@@ -391,35 +1063,98 @@ class SlackPlugin(object):
     def register_command(self, handler):
         self._handlers.register(handler.__name__, handler)
 
+    def _get_mention_re(self):
+        self_info = self._data_cache.peek_self()
+        if not self_info:
+            return None
+
+        key = (self_info["user_id"], self_info["user"])
+        if key != self._mention_re_key:
+            self._mention_re = re.compile("|".join(re.escape(word) for word in (
+                "<@" + self_info["user_id"] + ">", "harold", self_info["user"])),
+                re.IGNORECASE)
+            self._mention_re_key = key
+        return self._mention_re
+
+    def _guess_type(self, raw_payload):
+        # only used to label counters, so being fooled by a nested object
+        # that comes first is harmless.
+        match = _EVENT_TYPE_RE.search(raw_payload)
+        return match.group(1) if match else "unknown"
+
+    def _onFrame(self, raw_payload):
+        match = _HANDLED_EVENT_RE.search(raw_payload)
+        if not match:
+            metrics.increment("slack.rtm.dropped." + self._guess_type(raw_payload))
+            return
+
+        # a chat message only matters if it addresses harold, and that can't
+        # happen without harold's name or id appearing somewhere in the frame.
+        # until we know our own id, let everything through.
+        if match.group(1) == "message":
+            mention_re = self._get_mention_re()
+            if mention_re is not None and not mention_re.search(raw_payload):
+                metrics.increment(
+                    "slack.rtm.dropped." + self._guess_type(raw_payload))
+                return
+
+        metrics.increment("slack.rtm.decoded")
+        self._onMessage(json.loads(raw_payload))
+
     def _onMessage(self, payload):
-        event_type = payload["type"]
+        event_type = payload.get("type", "unknown")
 
         if event_type == "message":
+            if not self._is_addressed(payload):
+                metrics.increment("slack.rtm.dropped.message")
+                return
+            metrics.increment("slack.rtm.handled.message")
             self._onChat(payload)
-        elif event_type == "user_change":
+            return
+
+        if event_type == "user_change":
             self._data_cache.onUserChange(payload)
         elif event_type.startswith("channel_"):
             self._data_cache.onChannelChange(payload)
         elif event_type == "hello":
             print("Connected to Slack RTM!")
-            self._data_cache.initialize()
+            metrics.increment("slack.rtm.connects")
+            if self._connected_before:
+                metrics.increment("slack.rtm.reconnects")
+            self._connected_before = True
+            self._data_cache.refresh()
+        else:
+            metrics.increment("slack.rtm.dropped." + event_type)
+            return
 
-    @inlineCallbacks
-    def _onChat(self, payload):
+        metrics.increment("slack.rtm.handled." + event_type)
+
+    def _is_addressed(self, payload):
+        """Cheaply check whether a message could be a command for harold.
+
+        This runs before anything has to wait on the data cache, so the vast
+        majority of chatter is thrown away without further work. _onChat
+        makes the final decision.
+
+        """
         if payload.get("subtype") == "bot_message":
-            returnValue(None)
+            return False
 
         if payload.get("bot_id") is not None:
-            returnValue(None)
-
-        try:
-            words = payload["text"].split()
-        except KeyError:
-            returnValue(None)
+            return False
 
+        words = (payload.get("text") or "").split(None, 2)
         if len(words) < 2:
-            returnValue(None)
+            return False
+
+        mention_re = self._get_mention_re()
+        if mention_re is None:
+            return True
+        return mention_re.search(words[0]) is not None
 
+    @inlineCallbacks
+    def _onChat(self, payload):
+        words = payload["text"].split()
         self_info = yield self._data_cache.get_self()
         my_id = "<@" + self_info["user_id"] + ">"
         my_name = ("harold", self_info["user"])
@@ -430,10 +1165,10 @@ class SlackPlugin(object):
 
         channel_id = payload["channel"]
         channel_info = yield self._data_cache.get_channel_by_id(channel_id)
-        channel = '#' + channel_info["name"]
+        channel = '#' + channel_info.name
 
         user = yield self._data_cache.get_user_by_id(payload["user"])
-        sender_nick = user["name"]
+        sender_nick = user.name
 
         try:
             self._handlers.process(command, self.bot, sender_nick, channel, *args)
@@ -448,11 +1183,37 @@ class SlackPlugin(object):
 def make_plugin(application, app_config):
     slack_config = config.parse_config(app_config, {
         "token": config.String,
+        "max_backlog": config.Optional(config.Integer, default=1000),
+        "max_connections": config.Optional(config.Integer, default=8),
+        "request_timeout": config.Optional(
+            config.Timespan, default=datetime.timedelta(seconds=10)),
+        "circuit_failures": config.Optional(config.Integer, default=5),
+        "circuit_reset": config.Optional(
+            config.Timespan, default=datetime.timedelta(seconds=30)),
+        "coalesce_window": config.Optional(config.Timespan, default=None),
+        "snapshot_path": config.Optional(config.String, default=None),
+        "cache_max_age": config.Optional(
+            config.Timespan, default=datetime.timedelta(hours=1)),
     })
 
-    api_client = SlackWebClient(slack_config.token)
+    api_client = SlackWebClient(
+        slack_config.token,
+        max_backlog=slack_config.max_backlog,
+        max_connections=slack_config.max_connections,
+        request_timeout=slack_config.request_timeout.total_seconds(),
+        circuit_failures=slack_config.circuit_failures,
+        circuit_reset=slack_config.circuit_reset.total_seconds(),
+    )
     endpoint = SlackEndpoint(api_client)
-    plugin = SlackPlugin(api_client)
+    coalesce_window = 0
+    if slack_config.coalesce_window:
+        coalesce_window = slack_config.coalesce_window.total_seconds()
+    plugin = SlackPlugin(
+        api_client,
+        coalesce_window=coalesce_window,
+        snapshot_path=slack_config.snapshot_path,
+        cache_max_age=slack_config.cache_max_age.total_seconds(),
+    )
     factory = SlackClientFactory(
         plugin=plugin,
         useragent="Harold (neil@reddit.com)",
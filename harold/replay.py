@@ -0,0 +1,135 @@
+"""Replay a webhook journal through harold's github dispatchers.
+
+This is for reproducing throughput problems with real traffic and for
+rebuilding the review state and events tables after an outage. Chat messages
+are printed instead of being sent anywhere. The database given should be a
+scratch copy unless you really mean to rebuild production's tables.
+
+"""
+
+import argparse
+import json
+import sys
+import time
+import traceback
+
+from twisted.internet import reactor, task
+from twisted.internet.defer import inlineCallbacks
+from twisted.web import resource
+
+from harold.journal import read_journal
+from harold.plugins import database
+from harold.plugins.github import GitHubListener, payload_from_body
+from harold.plugins.http import HttpPlugin
+from harold.plugins.salons import SalonManagerPlugin
+
+
+class PrintingBot(object):
+    def __init__(self, quiet):
+        self.quiet = quiet
+
+    def _print(self, channel, text):
+        if self.quiet:
+            return
+
+        # print would encode as ascii whenever stdout isn't a terminal, e.g.
+        # piped through tee. and since this runs in the middle of a
+        # dispatcher, failing to print mustn't abort the delivery halfway.
+        try:
+            if isinstance(text, str):
+                text = text.decode("utf-8", "replace")
+            line = u"%s: %s\n" % (channel, text)
+            sys.stdout.write(line.encode("utf-8"))
+        except Exception:
+            traceback.print_exc()
+
+    def send_message(self, channel, message, **kwargs):
+        self._print(channel, message)
+
+    def describe(self, channel, message):
+        self._print(channel, "* " + message)
+
+    def set_topic(self, channel, topic):
+        self._print(channel, "(topic) " + topic)
+
+
+@inlineCallbacks
+def replay(args):
+    db = database.make_plugin({"connection_string": args.database})
+    salons = SalonManagerPlugin(db)
+    bot = PrintingBot(args.quiet)
+    http = HttpPlugin(resource.Resource(), hmac_secret=None)
+    listener = GitHubListener(http, bot, salons, db)
+
+    seen_deliveries = set()
+    first_received = None
+    start = time.time()
+    replayed = skipped = failed = 0
+
+    for record in read_journal(args.journal):
+        event = record.header("X-GitHub-Event")
+        dispatcher = listener.dispatchers.get(event)
+        delivery_id = record.header("X-GitHub-Delivery")
+        if not dispatcher or (args.events and event not in args.events):
+            skipped += 1
+            continue
+
+        if delivery_id:
+            if delivery_id in seen_deliveries:
+                skipped += 1
+                continue
+            seen_deliveries.add(delivery_id)
+
+        if args.speed:
+            if first_received is None:
+                first_received = record.received
+            due = start + (record.received - first_received) / args.speed
+            delay = due - time.time()
+            if delay > 0:
+                yield task.deferLater(reactor, delay, lambda: None)
+
+        try:
+            content_type = record.header("Content-Type", "")
+            payload = payload_from_body(content_type, record.body)
+            yield dispatcher(json.loads(payload))
+        except Exception:
+            failed += 1
+            print("Failed to replay %s delivery %s" % (event, delivery_id))
+            traceback.print_exc()
+        else:
+            replayed += 1
+
+    elapsed = time.time() - start
+    print("replayed %d deliveries (%d skipped, %d failed) in %.2f seconds "
+          "(%.1f/s)" % (replayed, skipped, failed, elapsed,
+                        replayed / elapsed if elapsed else 0.))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("journal", nargs="+",
+                        help="journal files or directories of them")
+    parser.add_argument("--database", required=True,
+                        help="sqlalchemy URL of a scratch database, "
+                             "e.g. sqlite:///scratch.db")
+    parser.add_argument("--speed", type=float, default=0.,
+                        help="speed multiplier relative to the original "
+                             "arrival times (default: 0, as fast as possible)")
+    parser.add_argument("--event", dest="events", action="append",
+                        help="only replay this event type (may be repeated)")
+    parser.add_argument("--quiet", action="store_true",
+                        help="don't print the chat messages harold would send")
+    args = parser.parse_args()
+
+    exit_code = []
+    def run():
+        d = replay(args)
+        d.addErrback(lambda failure: (exit_code.append(1), failure.printTraceback()))
+        d.addBoth(lambda ignored: reactor.stop())
+    reactor.callWhenRunning(run)
+    reactor.run()
+    sys.exit(exit_code and exit_code[0] or 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ import collections
 
 from flask_sqlalchemy import SQLAlchemy
 
+from harold import migrations
 from salon.app import app
 
 
@@ -156,6 +157,13 @@ class EmailAddress(db.Model):
         return self.email_address.partition("@")[0].lower().replace(".", "-")
 
 
+class Delivery(db.Model):
+    __tablename__ = "github_deliveries"
+
+    id = db.Column(db.String, primary_key=True)
+    received = db.Column(db.DateTime, nullable=False)
+
+
 class Event(db.Model):
     __tablename__ = "events"
 
@@ -168,4 +176,9 @@ class Event(db.Model):
     info = db.Column(db.JSON, nullable=False)
 
 
-db.create_all()
+# the schema is shared with harold, which applies the same migrations
+_connection = db.engine.raw_connection()
+try:
+    migrations.upgrade(_connection.connection)
+finally:
+    _connection.close()
@@ -23,6 +23,7 @@ setup(
     entry_points={
         "console_scripts": [
             "harold-register-webhooks = harold.webhooks:main",
+            "harold-replay = harold.replay:main",
             "salon-sync = salon.sync:main [salon]",
         ],
     },